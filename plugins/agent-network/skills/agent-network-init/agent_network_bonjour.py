@@ -22,6 +22,13 @@ SERVICE_TYPE = "_agent-network._tcp"
 DOMAIN = "local"
 RESOLVE_TIMEOUT = 5
 
+# dns-sd output parsers, compiled once (the browse one runs per output line)
+_BROWSE_RE = re.compile(
+    r"\s*\d+:\d+:\d+\.\d+\s+(Add|Rmv)\s+\d+\s+\d+\s+\S+\s+\S+\s+(.+)"
+)
+_REACH_RE = re.compile(r"can be reached at\s+(\S+):(\d+)")
+_TXT_RE = re.compile(r"(\w+)=(\S+)")
+
 
 def parse_browse_line(line: str) -> tuple[str, str] | None:
     """Parse a dns-sd -B output line into (action, service_name).
@@ -30,10 +37,7 @@ def parse_browse_line(line: str) -> tuple[str, str] | None:
     Example input:
       " 0:00:00.001  Add        3   4 local.  _agent-network._tcp. MacBookPro"
     """
-    m = re.match(
-        r"\s*\d+:\d+:\d+\.\d+\s+(Add|Rmv)\s+\d+\s+\d+\s+\S+\s+\S+\s+(.+)",
-        line,
-    )
+    m = _BROWSE_RE.match(line)
     if m:
         return m.group(1), m.group(2).strip()
     return None
@@ -86,9 +90,7 @@ def resolve_service(
                 break
 
             # Parse resolve line: "... can be reached at host.local.:port ..."
-            reach_match = re.search(
-                r"can be reached at\s+(\S+):(\d+)", line,
-            )
+            reach_match = _REACH_RE.search(line)
             if reach_match:
                 host = reach_match.group(1).rstrip(".")
                 port = int(reach_match.group(2))
@@ -108,7 +110,7 @@ def resolve_service(
 
                 txt_line = txt_result[0]
                 if txt_line:
-                    for kv in re.findall(r"(\w+)=(\S+)", txt_line):
+                    for kv in _TXT_RE.findall(txt_line):
                         txt[kv[0]] = kv[1]
                 break
     finally:
@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 """Agent Network HTTP Server — peer-to-peer transport for cross-machine messaging.
 
-Standalone HTTP server using stdlib only. Shares the same SQLite DB as the MCP
-server. Enables machines to pair and exchange messages over HTTP.
+Standalone HTTP server using stdlib only (orjson is used for serialization when
+installed). Shares the same SQLite DB as the MCP server. Enables machines to
+pair and exchange messages over HTTP.
 
 Usage: python3 agent_network_http.py [--port 7777] [--host 0.0.0.0]
 """
 
 import argparse
 import atexit
+import gzip
+import hmac
 import json
 import logging
 import os
+import queue
 import signal
 import socket
 import sqlite3
@@ -20,62 +24,449 @@ import threading
 import time
 import urllib.request
 import uuid
+import zlib
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, urlparse
 
 from agent_network_bonjour import BonjourBrowser, BonjourRegistrar, resolve_service
 
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    # json.loads accepts UTF-8 bytes directly
+    _loads = json.loads
+
 DB_PATH = os.environ.get(
     "AGENT_NETWORK_DB", os.path.expanduser("~/.claude/agent_network.db")
 )
 URL_FILE = os.path.expanduser("~/.claude/agent_network_http.url")
 PENDING_CAP_PER_PEER = 20
+# 8000-char content cap plus JSON envelope headroom
+MAX_BODY_BYTES = 16000
+HTTP_WORKERS = 16
+# Background writer: queue bound, ops per transaction, and how long to linger
+# collecting a batch / how long a handler waits for its op to commit
+WRITE_QUEUE_MAX = 10000
+WRITE_BATCH_MAX = 256
+WRITE_BATCH_WAIT = 0.005
+WRITE_WAIT_TIMEOUT = 1.0
+STREAM_FLUSH_BYTES = 16 * 1024
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_BYTES = 1024
+# Idle keep-alive connections are dropped after this many seconds so they
+# can't pin the worker pool
+KEEPALIVE_TIMEOUT = 30
+
+# Hot-path SQL, kept as module constants so every call hands sqlite3 the same
+# string and hits the connection's statement cache
+SQL_APPROVED_PEERS = (
+    "SELECT name, url, shared_secret, status, direction FROM peers "
+    "WHERE status = 'approved' AND direction = 'mutual'"
+)
+SQL_APPROVED_PEER_BY_NAME = SQL_APPROVED_PEERS + " AND name = ?"
+SQL_UPDATE_PEER_LAST_SEEN = (
+    "UPDATE peers SET last_seen = unixepoch('now') WHERE name = ?"
+)
+# Each row arrives already serialized by SQLite's json_object(), so
+# /api/agents never builds a per-row dict or calls the JSON encoder
+SQL_SELECT_SESSIONS = (
+    "SELECT json_object('agent_id', agent_id, 'role', role, 'is_active', "
+    "json(CASE WHEN (unixepoch('now') - last_seen) < 30 "
+    "THEN 'true' ELSE 'false' END)) AS doc, "
+    "(unixepoch('now') - last_seen) < 30 AS is_active "
+    "FROM sessions"
+)
+SQL_SELECT_SESSIONS_BY_NETWORK = SQL_SELECT_SESSIONS + " WHERE network_id = ?"
+# Cheap fingerprint of the agent list for /api/agents ETags. The active
+# count is included because is_active flips with the clock, not on writes.
+SQL_SESSIONS_VERSION = (
+    "SELECT COUNT(*), COALESCE(MAX(last_seen), 0), "
+    "COALESCE(SUM((unixepoch('now') - last_seen) < 30), 0) FROM sessions"
+)
+SQL_SESSIONS_VERSION_BY_NETWORK = SQL_SESSIONS_VERSION + " WHERE network_id = ?"
+SQL_SELECT_LOCAL_AGENT = (
+    "SELECT agent_id FROM sessions WHERE agent_id = ? AND network_id = ?"
+)
+SQL_PENDING_COUNT = (
+    "SELECT COUNT(*) as cnt FROM messages "
+    "WHERE sender_id = ? AND status = 'pending'"
+)
+SQL_INSERT_MESSAGE = (
+    "INSERT INTO messages (network_id, sender_id, recipient_id, content) "
+    "SELECT ?, ?, ?, ? WHERE ("
+    "SELECT COUNT(*) FROM messages "
+    "WHERE sender_id = ? AND status = 'pending') < ?"
+)
+SQL_INSERT_BROADCAST_PREFIX = (
+    "INSERT INTO messages "
+    "(network_id, sender_id, recipient_id, content, is_broadcast) VALUES "
+)
+SQL_BROADCAST_ROW = "(?, ?, ?, ?, 1)"
+SQL_INSERT_BROADCAST = SQL_INSERT_BROADCAST_PREFIX + SQL_BROADCAST_ROW
+SQL_INSERT_SYSTEM_NOTICE = (
+    "INSERT INTO messages (network_id, sender_id, recipient_id, content) "
+    "VALUES ('_peer_system', '_system', ?, ?)"
+)
+
+# INSERT ... RETURNING needs SQLite 3.35+
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
 logger = logging.getLogger("agent-network.http")
 
+# journal_mode and indexes are persistent on the DB file, so they only need
+# setting up once per process (set once the index DDL has succeeded)
+_db_initialized = False
+
+# Per-thread connection cache. Requests are served by a fixed pool of worker
+# threads (PooledHTTPServer), so each worker opens one connection and reuses
+# it for every request it handles. Every one opened lands in _CONNS so
+# shutdown can close them.
+_TLS = threading.local()
+_CONNS: list[sqlite3.Connection] = []
+_CONN_LOCK = threading.Lock()
 
-def _get_machine_name() -> str:
+
+def _compute_machine_name() -> str:
     return os.environ.get("AGENT_NETWORK_MACHINE_NAME", socket.gethostname())
 
 
+# Fixed for the process lifetime; avoids a gethostname() per health probe
+_MACHINE_NAME = _compute_machine_name()
+
+# /api/health never changes either, so its response (minus the protocol
+# version on the status line) is serialized once
+_HEALTH_BODY = _dumps({"status": "ok", "machine": _MACHINE_NAME})
+_HEALTH_RESPONSE = (
+    b" 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+    + str(len(_HEALTH_BODY)).encode() + b"\r\n\r\n" + _HEALTH_BODY
+)
+
+
 def _get_db() -> sqlite3.Connection:
-    db = sqlite3.connect(DB_PATH, isolation_level=None)
+    """Return this thread's cached connection, opening it on first use."""
+    global _db_initialized
+    db = getattr(_TLS, "db", None)
+    if db is not None:
+        return db
+    # isolation_level="IMMEDIATE": DML opens BEGIN IMMEDIATE implicitly and
+    # callers scope each write with `with db:` (commit, or rollback on error)
+    db = sqlite3.connect(
+        DB_PATH, isolation_level="IMMEDIATE", check_same_thread=False,
+        cached_statements=256,
+    )
     db.execute("PRAGMA busy_timeout=30000")
+    if not _db_initialized:
+        db.execute("PRAGMA journal_mode=WAL")
+        try:
+            # Pending-cap count in /api/deliver and network fan-out lookups
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_sender_status "
+                "ON messages(sender_id, status)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_network "
+                "ON sessions(network_id)"
+            )
+            _db_initialized = True
+        except sqlite3.OperationalError as e:
+            # Tables are created by the MCP server's init_db(); left unset
+            # so the next new connection tries again
+            logger.warning(f"Could not create indexes: {e}")
+    # Per-connection tuning: WAL makes NORMAL durable enough and avoids an
+    # fsync on every COMMIT
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-32000")
+    db.execute("PRAGMA wal_autocheckpoint=1000")
     db.row_factory = sqlite3.Row
+    _TLS.db = db
+    with _CONN_LOCK:
+        _CONNS.append(db)
     return db
 
 
+def _close_dbs():
+    """Close every pooled thread's connection (on shutdown)."""
+    with _CONN_LOCK:
+        for db in _CONNS:
+            try:
+                db.execute("PRAGMA optimize")
+                db.close()
+            except sqlite3.Error:
+                pass
+        _CONNS.clear()
+
+
+class _WriteOutcomeUnknown(Exception):
+    """The writer claimed an op but hasn't finished it within the wait."""
+
+
+class _WriteOp:
+    """One statement queued for the writer thread, plus its outcome."""
+
+    __slots__ = ("sql", "params", "many", "done", "state", "rows", "rowcount",
+                 "lastrowid", "error")
+
+    def __init__(self, sql: str, params, done: threading.Event | None,
+                 many: bool = False):
+        self.sql = sql
+        self.params = params
+        # executemany() over a sequence of parameter rows
+        self.many = many
+        self.done = done
+        # "queued" until the writer claims it ("claimed") or the submitter
+        # gives up on it first ("cancelled"); changes under _op_state_lock
+        self.state = "queued"
+        self.rows: list = []
+        self.rowcount = 0
+        self.lastrowid = None
+        self.error: Exception | None = None
+
+    def run(self, db: sqlite3.Connection):
+        if self.many:
+            self.rowcount = db.executemany(self.sql, self.params).rowcount
+            return
+        cursor = db.execute(self.sql, self.params)
+        # Drains RETURNING rows; empty for plain DML
+        self.rows = cursor.fetchall()
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+
+
+_write_q: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE_MAX)
+_op_state_lock = threading.Lock()
+_writer_lock = threading.Lock()
+_writer_thread: threading.Thread | None = None
+
+
+def _writer_loop():
+    """Drain the write queue, committing each batch in one transaction."""
+    db = _get_db()
+    while True:
+        batch = [_write_q.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WAIT
+        while len(batch) < WRITE_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_write_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Claim the batch; ops whose submitter already timed out are dropped
+        # unrun, so a 503 never hides a committed write
+        with _op_state_lock:
+            for op in batch:
+                if op.state == "queued":
+                    op.state = "claimed"
+        batch = [op for op in batch if op.state == "claimed"]
+        if not batch:
+            continue
+        try:
+            with db:
+                for op in batch:
+                    op.run(db)
+        except Exception:
+            # Something in the batch failed and the whole transaction rolled
+            # back. Replay one op per transaction so only the bad one errors.
+            for op in batch:
+                try:
+                    with db:
+                        op.run(db)
+                except Exception as e:
+                    op.error = e
+        for op in batch:
+            if op.done is not None:
+                op.done.set()
+            elif op.error is not None:
+                logger.warning(f"Background write failed: {op.error}")
+
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(
+                target=_writer_loop, name="agent-network-writer", daemon=True,
+            )
+            _writer_thread.start()
+
+
+def _submit_write(sql: str, params, wait: bool = True,
+                  many: bool = False) -> _WriteOp:
+    """Queue a write for the writer thread.
+
+    With wait=True, blocks until the op's batch has committed and re-raises
+    its error, if any. Raises queue.Full (nothing queued) or TimeoutError
+    (queued, then cancelled before the writer reached it) when the writer
+    is backed up; either way the write never happens. An op the writer
+    has already claimed gets a second WRITE_WAIT_TIMEOUT, after which
+    _WriteOutcomeUnknown is raised so a stalled writer can't pin the
+    handler thread.
+    """
+    _start_writer()
+    op = _WriteOp(sql, params, threading.Event() if wait else None, many)
+    _write_q.put(op, timeout=WRITE_WAIT_TIMEOUT)
+    if wait:
+        if not op.done.wait(WRITE_WAIT_TIMEOUT):
+            with _op_state_lock:
+                if op.state == "queued":
+                    op.state = "cancelled"
+            if op.state == "cancelled":
+                raise TimeoutError("write not committed in time")
+            if not op.done.wait(WRITE_WAIT_TIMEOUT):
+                logger.warning("Write still running after the wait; outcome unknown")
+                raise _WriteOutcomeUnknown("write claimed but not finished")
+        if op.error is not None:
+            raise op.error
+    return op
+
+
+def _accepts_gzip(handler: BaseHTTPRequestHandler) -> bool:
+    return "gzip" in handler.headers.get("Accept-Encoding", "")
+
+
+def _send_body(handler: BaseHTTPRequestHandler, code: int, body: bytes,
+               headers: dict | None = None):
+    """Send a complete JSON response, gzipped when large and accepted."""
+    head = [
+        f"{handler.protocol_version} {code} {handler.responses[code][0]}",
+        "Content-Type: application/json",
+    ]
+    for name, value in (headers or {}).items():
+        head.append(f"{name}: {value}")
+    if len(body) > GZIP_MIN_BYTES and _accepts_gzip(handler):
+        body = gzip.compress(body, compresslevel=1)
+        head.append("Content-Encoding: gzip")
+    if handler.close_connection:
+        head.append("Connection: close")
+    head.append(f"Content-Length: {len(body)}\r\n\r\n")
+    # Status line, headers and body go out in a single write
+    handler.wfile.write("\r\n".join(head).encode() + body)
+
+
 def _json_response(handler: BaseHTTPRequestHandler, code: int, data: dict):
-    body = json.dumps(data).encode()
-    handler.send_response(code)
-    handler.send_header("Content-Type", "application/json")
-    handler.send_header("Content-Length", str(len(body)))
-    handler.end_headers()
-    handler.wfile.write(body)
+    _send_body(handler, code, _dumps(data))
+
+
+class _JSONStream:
+    """Write a JSON response body incrementally.
+
+    Writes are buffered up to STREAM_FLUSH_BYTES so each send() carries many
+    rows. A body that never fills the buffer goes out as one ordinary
+    Content-Length response on close(). Larger bodies are streamed: chunked
+    under HTTP/1.1, delimited by closing the connection under HTTP/1.0, and
+    gzipped on the fly when the client accepts it.
+    """
+
+    def __init__(self, handler: BaseHTTPRequestHandler, code: int,
+                 headers: dict | None = None):
+        self.handler = handler
+        self.code = code
+        self.headers = headers or {}
+        self.buf = bytearray()
+        self.started = False
+        self.chunked = False
+        self.gz = None
+
+    def _start(self):
+        handler = self.handler
+        self.started = True
+        self.chunked = handler.request_version == "HTTP/1.1" and (
+            handler.protocol_version == "HTTP/1.1"
+        )
+        handler.send_response(self.code)
+        handler.send_header("Content-Type", "application/json")
+        for name, value in self.headers.items():
+            handler.send_header(name, value)
+        if _accepts_gzip(handler):
+            # wbits=31 selects the gzip container
+            self.gz = zlib.compressobj(1, zlib.DEFLATED, 31)
+            handler.send_header("Content-Encoding", "gzip")
+        if self.chunked:
+            handler.send_header("Transfer-Encoding", "chunked")
+        else:
+            handler.send_header("Connection", "close")
+            handler.close_connection = True
+        handler.end_headers()
+
+    def _send(self, data: bytes):
+        if not data:
+            return
+        if self.chunked:
+            self.handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.handler.wfile.write(data)
+
+    def write(self, data: bytes):
+        self.buf += data
+        if len(self.buf) >= STREAM_FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        if not self.started:
+            self._start()
+        data = bytes(self.buf)
+        self._send(self.gz.compress(data) if self.gz else data)
+        self.buf.clear()
+
+    def close(self):
+        if not self.started:
+            _send_body(self.handler, self.code, bytes(self.buf), self.headers)
+            return
+        self.flush()
+        if self.gz:
+            self._send(self.gz.flush())
+        if self.chunked:
+            self.handler.wfile.write(b"0\r\n\r\n")
 
 
 def _read_body(handler: BaseHTTPRequestHandler) -> dict:
-    length = int(handler.headers.get("Content-Length", 0))
-    if length == 0:
-        return {}
-    raw = handler.rfile.read(length)
-    return json.loads(raw.decode())
+    # do_POST has already read (and size-checked) the raw body
+    raw = handler.raw_body
+    return _loads(raw) if raw else {}
+
+
+def _secret_matches(peer: sqlite3.Row, token: bytes) -> bool:
+    return hmac.compare_digest((peer["shared_secret"] or "").encode(), token)
 
 
 def _auth_peer(handler: BaseHTTPRequestHandler, db: sqlite3.Connection) -> dict | None:
-    """Validate bearer token against peers table. Returns peer row or None."""
+    """Validate bearer token against peers table. Returns peer row or None.
+
+    Secrets are compared with hmac.compare_digest rather than in SQL, so
+    response timing doesn't reveal how much of a guessed token matched.
+    """
     auth = handler.headers.get("Authorization", "")
     if not auth.startswith("Bearer "):
         return None
-    token = auth[7:]
+    token = auth[7:].encode()
     if not token:
         return None
-    peer = db.execute(
-        "SELECT name, url, shared_secret, status, direction FROM peers "
-        "WHERE shared_secret = ? AND status = 'approved' AND direction = 'mutual'",
-        (token,),
-    ).fetchone()
-    return dict(peer) if peer else None
+
+    # Fast path: the caller names itself, so only one row is checked
+    peer_name = handler.headers.get("X-Peer-Name")
+    if peer_name:
+        peer = db.execute(SQL_APPROVED_PEER_BY_NAME, (peer_name,)).fetchone()
+        if peer and _secret_matches(peer, token):
+            return dict(peer)
+
+    # Older peers don't send X-Peer-Name, and we may have stored the caller
+    # under a friendly name that differs from its machine name. Check every
+    # approved peer without stopping early.
+    match = None
+    for peer in db.execute(SQL_APPROVED_PEERS):
+        if _secret_matches(peer, token) and match is None:
+            match = peer
+    return dict(match) if match else None
 
 
 def _auto_accept(peer_name: str, peer_url: str, local_port: int):
@@ -87,7 +478,7 @@ def _auto_accept(peer_name: str, peer_url: str, local_port: int):
     """
     time.sleep(0.5)
 
-    our_name = _get_machine_name()
+    our_name = _MACHINE_NAME
     our_url = f"http://{socket.gethostname()}.local:{local_port}"
 
     # Step 1: Accept locally via loopback
@@ -106,15 +497,11 @@ def _auto_accept(peer_name: str, peer_url: str, local_port: int):
 
     # Step 2: Read our stored secret so the remote can sync it
     peer_secret = ""
-    db = _get_db()
-    try:
-        row = db.execute(
-            "SELECT shared_secret FROM peers WHERE name = ?", (peer_name,),
-        ).fetchone()
-        if row:
-            peer_secret = row["shared_secret"]
-    finally:
-        db.close()
+    row = _get_db().execute(
+        "SELECT shared_secret FROM peers WHERE name = ?", (peer_name,),
+    ).fetchone()
+    if row:
+        peer_secret = row["shared_secret"]
 
     # Step 3: Notify remote so they also reach mutual (include secret for sync)
     try:
@@ -149,32 +536,26 @@ def _on_peer_discovered(name: str, machine_name: str, local_url: str, local_port
 
     # Skip if we already have this peer (any status)
     db = _get_db()
-    try:
-        existing = db.execute(
-            "SELECT status, direction FROM peers WHERE name = ?", (name,),
-        ).fetchone()
-    finally:
-        db.close()
+    existing = db.execute(
+        "SELECT status, direction FROM peers WHERE name = ?", (name,),
+    ).fetchone()
 
     if existing:
         return
 
     # New peer: generate shared secret and initiate pairing
     shared_secret = str(uuid.uuid4())
-    our_name = _get_machine_name()
+    our_name = _MACHINE_NAME
 
     # Insert outbound peer (INSERT OR IGNORE to avoid race conditions)
-    db = _get_db()
-    try:
+    with db:
         result = db.execute(
             "INSERT OR IGNORE INTO peers (name, url, shared_secret, status, direction) "
             "VALUES (?, ?, ?, 'pending', 'outbound')",
             (name, peer_url, shared_secret),
         )
-        if result.rowcount == 0:
-            return  # Peer was inserted by another thread
-    finally:
-        db.close()
+    if result.rowcount == 0:
+        return  # Peer was inserted by another thread
 
     # POST pair request to remote
     try:
@@ -198,101 +579,135 @@ def _on_peer_discovered(name: str, machine_name: str, local_url: str, local_port
 def _on_peer_removed(name: str):
     """Called by BonjourBrowser when a service disappears from LAN."""
     db = _get_db()
-    try:
-        db.execute(
-            "UPDATE peers SET last_seen = unixepoch('now') WHERE name = ?",
-            (name,),
-        )
-    finally:
-        db.close()
+    with db:
+        db.execute(SQL_UPDATE_PEER_LAST_SEEN, (name,))
 
 
 class AgentNetworkHandler(BaseHTTPRequestHandler):
     """HTTP request handler for agent network peer endpoints."""
 
+    # Keep-alive: peers poll repeatedly, so reuse the TCP connection.
+    # Every response carries Content-Length or chunked framing.
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
     # Set by main() so handlers can access the port for auto-accept loopback
     local_port: int = 7777
 
+    # Raw POST body, read by do_POST before dispatch
+    raw_body: bytes = b""
+
+    # Route table: path -> handler method name
+    _GET_ROUTES = {
+        "/api/health": "_handle_health",
+        "/api/agents": "_handle_agents",
+    }
+    _POST_ROUTES = {
+        "/api/deliver": "_handle_deliver",
+        "/api/pair/request": "_handle_pair_request",
+        "/api/pair/accept": "_handle_pair_accept",
+    }
+
     def log_message(self, fmt, *args):
         # Suppress default stderr logging
         pass
 
     def do_GET(self):
         parsed = urlparse(self.path)
-        path = parsed.path.rstrip("/")
+        path = parsed.path
+        if path.endswith("/"):
+            path = path.rstrip("/")
 
-        if path == "/api/health":
-            self._handle_health()
-        elif path == "/api/agents":
-            self._handle_agents(parsed)
+        handler = self._GET_ROUTES.get(path)
+        if handler:
+            getattr(self, handler)(parsed)
         else:
             _json_response(self, 404, {"error": "Not found"})
 
     def do_POST(self):
-        parsed = urlparse(self.path)
-        path = parsed.path.rstrip("/")
-
-        if path == "/api/deliver":
-            self._handle_deliver()
-        elif path == "/api/pair/request":
-            self._handle_pair_request()
-        elif path == "/api/pair/accept":
-            self._handle_pair_accept()
+        path = urlparse(self.path).path
+        if path.endswith("/"):
+            path = path.rstrip("/")
+
+        # Reject on the declared length, before anything is read off the
+        # socket. The unread body would desync keep-alive, so close.
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_BODY_BYTES:
+            self.close_connection = True
+            if length < 0:
+                _json_response(self, 400, {"error": "Invalid Content-Length"})
+            else:
+                _json_response(self, 413, {
+                    "error": f"Body exceeds {MAX_BODY_BYTES} bytes",
+                })
+            return
+        # Read the body up front, even if the handler bails out early
+        # (e.g. 401 or 404), so the next request on the connection starts clean
+        self.raw_body = self.rfile.read(length) if length else b""
+
+        handler = self._POST_ROUTES.get(path)
+        if handler:
+            getattr(self, handler)()
         else:
             _json_response(self, 404, {"error": "Not found"})
 
-    def _handle_health(self):
-        _json_response(self, 200, {
-            "status": "ok",
-            "machine": _get_machine_name(),
-        })
+    def _handle_health(self, parsed):
+        self.wfile.write(self.protocol_version.encode() + _HEALTH_RESPONSE)
 
     def _handle_agents(self, parsed):
         db = _get_db()
-        try:
-            # Auth check
-            peer = _auth_peer(self, db)
-            if not peer:
-                _json_response(self, 401, {"error": "Unauthorized"})
-                return
+        # Auth check
+        peer = _auth_peer(self, db)
+        if not peer:
+            _json_response(self, 401, {"error": "Unauthorized"})
+            return
 
-            # Update last_seen for this peer
-            db.execute(
-                "UPDATE peers SET last_seen = unixepoch('now') WHERE name = ?",
-                (peer["name"],),
-            )
+        # Update last_seen for this peer
+        with db:
+            db.execute(SQL_UPDATE_PEER_LAST_SEEN, (peer["name"],))
 
-            qs = parse_qs(parsed.query)
-            network_id = qs.get("network_id", [None])[0]
+        qs = parse_qs(parsed.query)
+        network_id = qs.get("network_id", [None])[0]
 
-            if network_id:
-                rows = db.execute(
-                    "SELECT agent_id, role, last_seen FROM sessions "
-                    "WHERE network_id = ?",
-                    (network_id,),
-                ).fetchall()
-            else:
-                rows = db.execute(
-                    "SELECT agent_id, role, last_seen FROM sessions"
-                ).fetchall()
-
-            now = time.time()
-            agents = []
-            for r in rows:
-                active = (now - r["last_seen"]) < 30
-                agents.append({
-                    "agent_id": r["agent_id"],
-                    "role": r["role"],
-                    "is_active": active,
-                })
-
-            # Filter to active-only when requested (default: all)
-            if qs.get("active", ["0"])[0] == "1":
-                agents = [a for a in agents if a["is_active"]]
+        # Peers poll this constantly; answer 304 when nothing has changed
+        if network_id:
+            version = db.execute(
+                SQL_SESSIONS_VERSION_BY_NETWORK, (network_id,),
+            ).fetchone()
+        else:
+            version = db.execute(SQL_SESSIONS_VERSION).fetchone()
+        etag = 'W/"%d-%d-%d"' % tuple(version)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
 
-            _json_response(self, 200, {"agents": agents, "count": len(agents)})
-        finally:
-            db.close()
+        # Iterate the cursor rather than fetchall() so rows go straight from
+        # SQLite to the socket without building the full list first
+        if network_id:
+            rows = db.execute(SQL_SELECT_SESSIONS_BY_NETWORK, (network_id,))
+        else:
+            rows = db.execute(SQL_SELECT_SESSIONS)
+
+        # Filter to active-only when requested (default: all)
+        active_only = qs.get("active", ["0"])[0] == "1"
+
+        stream = _JSONStream(self, 200, {"ETag": etag})
+        stream.write(b'{"agents":[')
+        count = 0
+        for doc, is_active in rows:
+            if active_only and not is_active:
+                continue
+            if count:
+                stream.write(b",")
+            stream.write(doc.encode())
+            count += 1
+        stream.write(b'],"count":%d}' % count)
+        stream.close()
 
     def _handle_deliver(self):
         db = _get_db()
@@ -313,41 +728,44 @@ class AgentNetworkHandler(BaseHTTPRequestHandler):
                 _json_response(self, 400, {"error": "Content exceeds 8000 chars"})
                 return
 
-            # Pending cap per peer
-            pending_count = db.execute(
-                "SELECT COUNT(*) as cnt FROM messages "
-                "WHERE sender_id = ? AND status = 'pending'",
-                (sender_id,),
-            ).fetchone()["cnt"]
-            if pending_count >= PENDING_CAP_PER_PEER:
-                _json_response(self, 429, {
-                    "error": f"Too many pending messages from {sender_id}",
-                })
-                return
-
             if is_broadcast:
+                # Pending cap per peer
+                pending_count = db.execute(
+                    SQL_PENDING_COUNT, (sender_id,),
+                ).fetchone()["cnt"]
+                if pending_count >= PENDING_CAP_PER_PEER:
+                    _json_response(self, 429, {
+                        "error": f"Too many pending messages from {sender_id}",
+                    })
+                    return
+
                 # Fan out to all local agents in this network
                 recipients = db.execute(
                     "SELECT agent_id FROM sessions WHERE network_id = ?",
                     (network_id,),
                 ).fetchall()
 
-                db.execute("BEGIN IMMEDIATE")
-                delivered = 0
-                for r in recipients:
-                    db.execute(
-                        "INSERT INTO messages "
-                        "(network_id, sender_id, recipient_id, content, is_broadcast) "
-                        "VALUES (?, ?, ?, ?, 1)",
-                        (network_id, sender_id, r["agent_id"], content),
+                params = [
+                    (network_id, sender_id, r["agent_id"], content)
+                    for r in recipients
+                ]
+                message_ids = None
+                if _HAS_RETURNING and params:
+                    # One multi-row INSERT that hands back the new ids
+                    op = _submit_write(
+                        SQL_INSERT_BROADCAST_PREFIX
+                        + ", ".join([SQL_BROADCAST_ROW] * len(params))
+                        + " RETURNING id",
+                        [v for row in params for v in row],
                     )
-                    delivered += 1
-                db.execute("COMMIT")
-
-                _json_response(self, 200, {
-                    "status": "delivered",
-                    "delivered_count": delivered,
-                })
+                    message_ids = [r["id"] for r in op.rows]
+                elif params:
+                    _submit_write(SQL_INSERT_BROADCAST, params, many=True)
+
+                result = {"status": "delivered", "delivered_count": len(params)}
+                if message_ids is not None:
+                    result["message_ids"] = message_ids
+                _json_response(self, 200, result)
             else:
                 # Single recipient
                 if not recipient_id:
@@ -355,9 +773,7 @@ class AgentNetworkHandler(BaseHTTPRequestHandler):
                     return
 
                 local = db.execute(
-                    "SELECT agent_id FROM sessions "
-                    "WHERE agent_id = ? AND network_id = ?",
-                    (recipient_id, network_id),
+                    SQL_SELECT_LOCAL_AGENT, (recipient_id, network_id),
                 ).fetchone()
                 if not local:
                     _json_response(self, 404, {
@@ -365,27 +781,50 @@ class AgentNetworkHandler(BaseHTTPRequestHandler):
                     })
                     return
 
-                db.execute("BEGIN IMMEDIATE")
-                db.execute(
-                    "INSERT INTO messages "
-                    "(network_id, sender_id, recipient_id, content) "
-                    "VALUES (?, ?, ?, ?)",
-                    (network_id, sender_id, recipient_id, content),
-                )
-                db.execute("COMMIT")
+                # Pending cap per peer is checked in the same statement as
+                # the insert, so concurrent delivers can't race past it
+                params = (network_id, sender_id, recipient_id, content,
+                          sender_id, PENDING_CAP_PER_PEER)
+                if _HAS_RETURNING:
+                    op = _submit_write(SQL_INSERT_MESSAGE + " RETURNING id", params)
+                    message_id = op.rows[0]["id"] if op.rows else None
+                else:
+                    op = _submit_write(SQL_INSERT_MESSAGE, params)
+                    message_id = op.lastrowid if op.rowcount else None
+                if message_id is None:
+                    _json_response(self, 429, {
+                        "error": f"Too many pending messages from {sender_id}",
+                    })
+                    return
 
                 _json_response(self, 200, {
                     "status": "delivered",
                     "delivered_count": 1,
+                    "message_id": message_id,
                 })
+        except queue.Full:
+            _json_response(self, 503, {
+                "error": (
+                    "Server busy: write queue full, message not stored. "
+                    "Retry later"
+                ),
+            })
+        except TimeoutError:
+            _json_response(self, 503, {
+                "error": (
+                    "Server busy: write timed out, message not stored. "
+                    "Retry later"
+                ),
+            })
+        except _WriteOutcomeUnknown:
+            _json_response(self, 503, {
+                "error": (
+                    "Server busy: write still in progress, outcome unknown. "
+                    "Check before retrying"
+                ),
+            })
         except Exception:
-            try:
-                db.execute("ROLLBACK")
-            except Exception:
-                pass
             _json_response(self, 500, {"error": "Internal server error"})
-        finally:
-            db.close()
 
     def _handle_pair_request(self):
         db = _get_db()
@@ -422,48 +861,36 @@ class AgentNetworkHandler(BaseHTTPRequestHandler):
                 and existing["direction"] == "inbound"
             )
 
-            db.execute("BEGIN IMMEDIATE")
-            db.execute(
-                """INSERT INTO peers (name, url, shared_secret, status, direction)
-                   VALUES (?, ?, ?, 'pending', 'inbound')
-                   ON CONFLICT(name) DO UPDATE SET
-                       url=excluded.url, shared_secret=excluded.shared_secret,
-                       status='pending', direction='inbound'""",
-                (peer_name, peer_url, secret),
-            )
-
             auto_pair = os.environ.get("AGENT_NETWORK_AUTO_PAIR") == "1"
 
-            # Only notify local agents on the first request
-            if not is_duplicate:
-                if auto_pair:
-                    # Suppress manual approval notification for auto-pair
-                    sessions = db.execute("SELECT agent_id FROM sessions").fetchall()
-                    for s in sessions:
-                        db.execute(
-                            "INSERT INTO messages "
-                            "(network_id, sender_id, recipient_id, content) "
-                            "VALUES ('_peer_system', '_system', ?, ?)",
-                            (
-                                s["agent_id"],
-                                f"Auto-pairing with '{peer_name}' ({peer_url}) "
-                                "via Bonjour LAN discovery...",
-                            ),
+            with db:
+                db.execute(
+                    """INSERT INTO peers (name, url, shared_secret, status, direction)
+                       VALUES (?, ?, ?, 'pending', 'inbound')
+                       ON CONFLICT(name) DO UPDATE SET
+                           url=excluded.url, shared_secret=excluded.shared_secret,
+                           status='pending', direction='inbound'""",
+                    (peer_name, peer_url, secret),
+                )
+
+                # Only notify local agents on the first request
+                if not is_duplicate:
+                    if auto_pair:
+                        # Suppress manual approval notification for auto-pair
+                        notice = (
+                            f"Auto-pairing with '{peer_name}' ({peer_url}) "
+                            "via Bonjour LAN discovery..."
                         )
-                else:
-                    sessions = db.execute("SELECT agent_id FROM sessions").fetchall()
-                    for s in sessions:
-                        db.execute(
-                            "INSERT INTO messages "
-                            "(network_id, sender_id, recipient_id, content) "
-                            "VALUES ('_peer_system', '_system', ?, ?)",
-                            (
-                                s["agent_id"],
-                                f"Pairing request from '{peer_name}' ({peer_url}). "
-                                f"Use approve_peer('{peer_name}') to accept.",
-                            ),
+                    else:
+                        notice = (
+                            f"Pairing request from '{peer_name}' ({peer_url}). "
+                            f"Use approve_peer('{peer_name}') to accept."
                         )
-            db.execute("COMMIT")
+                    sessions = db.execute("SELECT agent_id FROM sessions").fetchall()
+                    db.executemany(
+                        SQL_INSERT_SYSTEM_NOTICE,
+                        [(s["agent_id"], notice) for s in sessions],
+                    )
 
             # Trigger auto-accept in a background thread
             if auto_pair and not is_duplicate:
@@ -480,13 +907,7 @@ class AgentNetworkHandler(BaseHTTPRequestHandler):
                 + (" (auto-accepting)" if auto_pair and not is_duplicate else ""),
             })
         except Exception:
-            try:
-                db.execute("ROLLBACK")
-            except Exception:
-                pass
             _json_response(self, 500, {"error": "Internal server error"})
-        finally:
-            db.close()
 
     def _handle_pair_accept(self):
         db = _get_db()
@@ -525,47 +946,63 @@ class AgentNetworkHandler(BaseHTTPRequestHandler):
             # when URL fallback was used)
             stored_name = peer["name"]
 
-            db.execute("BEGIN IMMEDIATE")
-            if peer_secret:
-                db.execute(
-                    "UPDATE peers SET status = 'approved', direction = 'mutual', "
-                    "shared_secret = ?, last_seen = unixepoch('now') WHERE name = ?",
-                    (peer_secret, stored_name),
-                )
-            else:
-                db.execute(
-                    "UPDATE peers SET status = 'approved', direction = 'mutual', "
-                    "last_seen = unixepoch('now') WHERE name = ?",
-                    (stored_name,),
-                )
+            with db:
+                if peer_secret:
+                    db.execute(
+                        "UPDATE peers SET status = 'approved', direction = 'mutual', "
+                        "shared_secret = ?, last_seen = unixepoch('now') WHERE name = ?",
+                        (peer_secret, stored_name),
+                    )
+                else:
+                    db.execute(
+                        "UPDATE peers SET status = 'approved', direction = 'mutual', "
+                        "last_seen = unixepoch('now') WHERE name = ?",
+                        (stored_name,),
+                    )
 
-            # Write system notification
-            sessions = db.execute("SELECT agent_id FROM sessions").fetchall()
-            for s in sessions:
-                db.execute(
-                    "INSERT INTO messages "
-                    "(network_id, sender_id, recipient_id, content) "
-                    "VALUES ('_peer_system', '_system', ?, ?)",
-                    (
-                        s["agent_id"],
-                        f"Peer '{stored_name}' pairing confirmed. "
-                        "Cross-machine messaging is now active.",
-                    ),
+                # Write system notification
+                notice = (
+                    f"Peer '{stored_name}' pairing confirmed. "
+                    "Cross-machine messaging is now active."
+                )
+                sessions = db.execute("SELECT agent_id FROM sessions").fetchall()
+                db.executemany(
+                    SQL_INSERT_SYSTEM_NOTICE,
+                    [(s["agent_id"], notice) for s in sessions],
                 )
-            db.execute("COMMIT")
 
             _json_response(self, 200, {
                 "status": "approved",
                 "message": "Pairing confirmed",
             })
         except Exception:
-            try:
-                db.execute("ROLLBACK")
-            except Exception:
-                pass
             _json_response(self, 500, {"error": "Internal server error"})
-        finally:
-            db.close()
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that hands connections to a fixed worker pool.
+
+    Avoids spawning an OS thread per connection and bounds concurrency under
+    bursts of /api/deliver calls. Workers keep their thread-local DB
+    connection across the connections they serve. Like ThreadingHTTPServer's
+    threads they are daemons, so an idle keep-alive client can't block exit.
+    """
+
+    def __init__(self, server_address, handler_class, workers: int = HTTP_WORKERS):
+        super().__init__(server_address, handler_class)
+        self._requests: queue.SimpleQueue = queue.SimpleQueue()
+        for i in range(workers):
+            threading.Thread(
+                target=self._worker, name=f"agent-network-http-{i}", daemon=True,
+            ).start()
+
+    def _worker(self):
+        while True:
+            request, client_address = self._requests.get()
+            self.process_request_thread(request, client_address)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
 
 
 def main():
@@ -576,7 +1013,7 @@ def main():
     )
     args = parser.parse_args()
 
-    machine_name = _get_machine_name()
+    machine_name = _MACHINE_NAME
     local_url = f"http://{socket.gethostname()}.local:{args.port}"
 
     # Write URL file for MCP server discovery
@@ -587,7 +1024,8 @@ def main():
     # Make the port available to request handlers for auto-accept loopback
     AgentNetworkHandler.local_port = args.port
 
-    server = ThreadingHTTPServer((args.host, args.port), AgentNetworkHandler)
+    _start_writer()
+    server = PooledHTTPServer((args.host, args.port), AgentNetworkHandler)
     print(f"Agent Network HTTP server on {args.host}:{args.port}")
     print(f"Machine name: {machine_name}")
     print(f"URL: {local_url}")
@@ -623,11 +1061,12 @@ def main():
             os.unlink(URL_FILE)
         except OSError:
             pass
+        _close_dbs()
 
     atexit.register(cleanup)
 
     def sigterm_handler(signum, frame):
-        cleanup()
+        # Unwinds serve_forever() so the finally below runs
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, sigterm_handler)
@@ -636,8 +1075,12 @@ def main():
         server.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down.")
-        cleanup()
+    finally:
+        # serve_forever() has returned, so shutdown() doesn't block; the
+        # listening socket closes before the pooled connections do
         server.shutdown()
+        server.server_close()
+        cleanup()
 
 
 if __name__ == "__main__":
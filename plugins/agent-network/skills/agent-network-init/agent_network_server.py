@@ -6,18 +6,42 @@ instances each spawn their own server process; all share the same database.
 """
 
 import asyncio
+import atexit
 import json
 import logging
 import os
+import queue
+import re
+import shlex
 import socket
 import sqlite3
 import subprocess
+import threading
 import time
 import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from mcp.server.fastmcp import FastMCP
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    # json.loads accepts UTF-8 bytes directly
+    _loads = json.loads
+
 # --- Constants ---
 
 DB_PATH = os.environ.get(
@@ -25,11 +49,159 @@ DB_PATH = os.environ.get(
 )
 LOG_PATH = os.path.expanduser("~/.claude/agent_network.log")
 SESSIONS_DIR = os.path.expanduser("~/.claude/agent_network/sessions")
+# One empty file per session that is in a network, so the Stop hook can
+# skip SQLite for every session that isn't
+JOINED_DIR = os.path.expanduser("~/.claude/agent_network/joined")
 AGENT_EXPIRY_SECONDS = 30
+# wait_for_message: how often to check PRAGMA data_version (a header read,
+# no table access) and how often to refresh the waiter's heartbeat
+WAIT_POLL_SECONDS = 0.25
+WAIT_HEARTBEAT_SECONDS = 2
+# How often each cached connection runs _maintain_db()
+OPTIMIZE_INTERVAL = 3600
+# Delivered messages are kept this long (same as the SessionStart purge)
+MESSAGE_TTL_SECONDS = 7 * 24 * 3600
+# Free pages returned to the filesystem per maintenance pass
+VACUUM_PAGES = 200
+# send_message: guarded re-inserts after a refusal whose cause had cleared
+SEND_RETRIES = 2
+# Valid agent_id / peer name. \Z rather than $ so a trailing newline can't
+# slip through into the listener command.
+_ID_RE = re.compile(r"\A[A-Za-z0-9_-]+\Z")
+# Set AGENT_NETWORK_AUDIT=0 to turn off the JSONL audit log
+_AUDIT_ENABLED = os.environ.get("AGENT_NETWORK_AUDIT", "1") == "1"
+
+# UPDATE/INSERT ... RETURNING needs SQLite 3.35+
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Linux: parent PIDs can be read straight from /proc/<pid>/stat
+_HAS_PROC = os.path.isdir("/proc/self")
+
+# --- SQL ---
+# Hot-path statements live here so every call site shares one string, and
+# with it one entry in the connection's prepared-statement cache.
+
+SQL_SELECT_IDENTITY = (
+    "SELECT agent_id, network_id FROM sessions WHERE session_id = ?"
+)
+SQL_SELECT_LOCAL_AGENT = (
+    "SELECT agent_id FROM sessions WHERE agent_id = ? AND network_id = ?"
+)
+# list_agents/list_peers payloads, built as one JSON array by SQLite.
+# json('true'/'false') because json_object() would emit 1/0 for a bare
+# comparison.
+SQL_NETWORK_AGENTS_JSON = """SELECT json_group_array(json_object(
+          'agent_id', agent_id,
+          'role', role,
+          'last_seen_seconds_ago',
+              CAST(ROUND(unixepoch('now') - last_seen) AS INTEGER),
+          'is_active', json(CASE WHEN unixepoch('now') - last_seen < ?
+                                 THEN 'true' ELSE 'false' END),
+          'is_you', json(CASE WHEN agent_id = ?
+                              THEN 'true' ELSE 'false' END)))
+   FROM (SELECT agent_id, role, last_seen FROM sessions
+         WHERE network_id = ? ORDER BY agent_id)"""
+SQL_PEERS_JSON = """SELECT json_group_array(json_object(
+          'name', name, 'url', url, 'status', status,
+          'direction', direction, 'last_seen', last_seen,
+          'created_at', created_at))
+   FROM (SELECT * FROM peers ORDER BY created_at)"""
+SQL_HEARTBEAT = (
+    "UPDATE sessions SET last_seen = unixepoch('now') WHERE session_id = ?"
+)
+SQL_APPROVED_PEERS = (
+    "SELECT name, url, shared_secret FROM peers "
+    "WHERE status = 'approved' AND direction = 'mutual'"
+)
+SQL_APPROVED_PEER_COUNT = (
+    "SELECT COUNT(*) as cnt FROM peers "
+    "WHERE status = 'approved' AND direction = 'mutual'"
+)
+SQL_PAIR_COUNTS = """SELECT COALESCE(SUM(status = 'pending'), 0) AS unread,
+          COALESCE(SUM(created_at > unixepoch('now') - 60), 0) AS recent
+   FROM messages WHERE sender_id = ? AND recipient_id = ?"""
+# Broadcast recipients already at the unread cap or the rate limit
+SQL_BROADCAST_BLOCKED = """SELECT recipient_id,
+          SUM(status = 'pending') AS unread,
+          SUM(created_at > unixepoch('now') - 60) AS recent
+   FROM messages
+   WHERE sender_id = ? AND recipient_id IN (
+       SELECT agent_id FROM sessions
+       WHERE network_id = ? AND agent_id != ?)
+   GROUP BY recipient_id
+   HAVING unread >= 5 OR recent >= 10"""
+# Local recipient check, unread cap (5) and rate limit (10/60s) folded into
+# the insert; no row inserted means one of them refused it
+SQL_INSERT_MESSAGE_CHECKED = """INSERT INTO messages
+       (network_id, sender_id, recipient_id, content)
+   SELECT ?, ?, ?, ?
+   WHERE EXISTS (SELECT 1 FROM sessions WHERE agent_id = ? AND network_id = ?)
+     AND (SELECT COALESCE(SUM(status = 'pending'), 0) < 5
+             AND COALESCE(SUM(created_at > unixepoch('now') - 60), 0) < 10
+          FROM messages WHERE sender_id = ? AND recipient_id = ?)"""
+# One row per other agent in the network that is under both caps
+SQL_INSERT_BROADCAST = """INSERT INTO messages
+       (network_id, sender_id, recipient_id, content, is_broadcast)
+   SELECT s.network_id, ?, s.agent_id, ?, 1
+   FROM sessions s
+   WHERE s.network_id = ? AND s.agent_id != ?
+     AND (SELECT COALESCE(SUM(status = 'pending'), 0) < 5
+             AND COALESCE(SUM(created_at > unixepoch('now') - 60), 0) < 10
+          FROM messages WHERE sender_id = ? AND recipient_id = s.agent_id)"""
+SQL_CLAIM_PENDING = """UPDATE messages
+   SET status = 'delivered', delivered_at = unixepoch('now')
+   WHERE id IN (
+       SELECT id FROM messages
+       WHERE recipient_id = ? AND status = 'pending'
+       ORDER BY created_at, id LIMIT ?)
+   RETURNING id, sender_id, content, is_broadcast, created_at"""
+SQL_SELECT_PENDING = """SELECT id, sender_id, content, is_broadcast, created_at
+   FROM messages WHERE recipient_id = ? AND status = 'pending'
+   ORDER BY created_at LIMIT ?"""
+SQL_HAS_PENDING = (
+    "SELECT EXISTS (SELECT 1 FROM messages "
+    "WHERE recipient_id = ? AND status = 'pending')"
+)
+SQL_PENDING_AT_LEAST = (
+    "SELECT COUNT(*) as cnt FROM (SELECT 1 FROM messages "
+    "WHERE recipient_id = ? AND status = 'pending' LIMIT ?)"
+)
+# Anything in the peer outbox due for a send attempt?
+SQL_OUTBOX_DUE = (
+    "SELECT 1 FROM peer_outbox WHERE next_attempt_at <= unixepoch('now') LIMIT 1"
+)
 
 # Module-level cache for resolved session ID
 _cached_session_id: str | None = None
 
+# Parsed session state files: {fname: (st_mtime_ns, state)}. Lets repeat
+# scans in _resolve_session_id() skip re-reading files that haven't changed.
+_SESSION_FILE_CACHE: dict[str, tuple[int, dict]] = {}
+
+# SESSIONS_DIR mtime of the last scan that found no match. The SessionStart
+# hook writes state files by rename, so an unchanged mtime means a rescan
+# would miss again.
+_SESSIONS_DIR_MISS_MTIME: int | None = None
+
+# This process's PID ancestry, walked once by _get_pid_ancestry()
+_PID_ANCESTRY: set[int] | None = None
+
+# (agent_id, network_id) for this session. Only join_network/leave_network
+# change it, so they keep it current.
+_cached_identity: tuple[str, str] | None = None
+
+# One cached connection per thread, opened on first use by _get_db(), so the
+# tool thread and the outbox worker never share a connection. Every one
+# opened lands in _CONNS for the atexit close. Writers still take
+# _WRITE_LOCK so in-process transactions queue on a lock instead of in
+# SQLite's sleep-and-retry busy handler. Call _get_db() before taking
+# _WRITE_LOCK: it may run _maintain_db(), which takes the lock itself
+# (re-entrant, so a caller that slips up doesn't deadlock).
+_CONN_LOCAL = threading.local()
+_CONNS: list[sqlite3.Connection] = []
+_CONN_LOCK = threading.Lock()
+_WRITE_LOCK = threading.RLock()
+
 # Configure logging to stderr (never stdout — that's JSON-RPC)
 logging.basicConfig(
     level=logging.INFO,
@@ -44,12 +216,30 @@ mcp = FastMCP("agent-network")
 # --- Database ---
 
 
+def _tune_connection(db: sqlite3.Connection):
+    """Apply the per-connection pragmas (only journal_mode persists in the file).
+
+    WAL makes synchronous=NORMAL durable enough and drops the fsync from
+    every COMMIT; mmap lets read-heavy paths hit the page cache directly.
+    """
+    db.execute("PRAGMA busy_timeout=30000")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-64000")
+    db.execute("PRAGMA wal_autocheckpoint=1000")
+    if DB_PATH != ":memory:":
+        db.execute("PRAGMA mmap_size=268435456")
+
+
 def init_db():
     """Create database and tables if they don't exist."""
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     db = sqlite3.connect(DB_PATH)
+    _tune_connection(db)  # busy_timeout first, journal_mode may need a lock
+    # Only takes effect while the file has no tables, i.e. on a fresh DB;
+    # _maintain_db() then hands purged pages back in small steps
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
     db.execute("PRAGMA journal_mode=WAL")
-    db.execute("PRAGMA busy_timeout=30000")
     db.executescript("""
         CREATE TABLE IF NOT EXISTS sessions (
             session_id TEXT PRIMARY KEY,
@@ -71,10 +261,24 @@ def init_db():
             created_at REAL NOT NULL DEFAULT (unixepoch('now')),
             delivered_at REAL
         );
-        CREATE INDEX IF NOT EXISTS idx_messages_inbox
-            ON messages(recipient_id, status) WHERE status = 'pending';
+        -- Pending inbox in delivery order, so the claim/fetch ORDER BY
+        -- reads straight off the index; the trailing status keeps the
+        -- hooks' and listener's pending COUNTs index-only. Replaces
+        -- idx_messages_inbox (recipient_id, status), which needed a sort.
+        DROP INDEX IF EXISTS idx_messages_inbox;
+        CREATE INDEX IF NOT EXISTS idx_messages_pending
+            ON messages(recipient_id, created_at, status)
+            WHERE status = 'pending';
+        -- TTL purge (SessionStart hook and _maintain_db) walks only the
+        -- expired delivered rows instead of the whole table
+        CREATE INDEX IF NOT EXISTS idx_messages_delivered
+            ON messages(delivered_at) WHERE status = 'delivered';
         CREATE INDEX IF NOT EXISTS idx_sessions_network
             ON sessions(network_id);
+        -- Covers the per-pair unread/rate-limit counts in send_message()
+        -- and broadcast()
+        CREATE INDEX IF NOT EXISTS idx_messages_pair
+            ON messages(sender_id, recipient_id, created_at, status);
         CREATE TABLE IF NOT EXISTS peers (
             name TEXT PRIMARY KEY,
             url TEXT NOT NULL,
@@ -86,24 +290,115 @@ def init_db():
             created_at REAL NOT NULL DEFAULT (unixepoch('now')),
             last_seen REAL
         );
+        CREATE TABLE IF NOT EXISTS peer_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            network_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            recipient_id TEXT NOT NULL,
+            content TEXT NOT NULL CHECK(length(content) <= 8000),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT (unixepoch('now')),
+            created_at REAL NOT NULL DEFAULT (unixepoch('now'))
+        );
     """)
+    # Refresh planner stats for the (partial) indexes if they've drifted
+    db.execute("PRAGMA optimize")
     db.close()
 
 
 def _get_db() -> sqlite3.Connection:
-    """Get a fresh short-lived database connection."""
-    db = sqlite3.connect(DB_PATH, isolation_level=None)
-    db.execute("PRAGMA busy_timeout=30000")
+    """Get this thread's database connection, opening it on first use.
+
+    Kept open for the life of the server so the page cache and prepared
+    statements survive between tool calls.
+    """
+    db = getattr(_CONN_LOCAL, "db", None)
+    if db is not None:
+        if time.monotonic() >= _CONN_LOCAL.optimize_at:
+            _CONN_LOCAL.optimize_at = time.monotonic() + OPTIMIZE_INTERVAL
+            _maintain_db(db)
+        return db
+    # check_same_thread=False only so _close_dbs() can close it at exit.
+    # The statement cache is keyed on SQL text, so the SQL_* constants are
+    # compiled once per connection; size it to hold every one.
+    db = sqlite3.connect(
+        DB_PATH, isolation_level=None, check_same_thread=False,
+        cached_statements=256,
+    )
+    _tune_connection(db)
+    db.execute("PRAGMA journal_mode=WAL")
     db.row_factory = sqlite3.Row
+    _CONN_LOCAL.db = db
+    _CONN_LOCAL.optimize_at = time.monotonic() + OPTIMIZE_INTERVAL
+    with _CONN_LOCK:
+        if not _CONNS:
+            atexit.register(_close_dbs)
+        _CONNS.append(db)
     return db
 
 
+def _maintain_db(db: sqlite3.Connection):
+    """Periodic upkeep for a long-lived connection.
+
+    Re-ANALYZEs as the pending/delivered mix in messages shifts, purges
+    expired delivered messages (a server can outlive many SessionStart
+    purges' worth of traffic), and reclaims a bounded number of free pages.
+    """
+    if db.in_transaction:
+        # Never purge or vacuum inside a caller's transaction; the next
+        # _get_db() after it finishes picks this up instead
+        _CONN_LOCAL.optimize_at = 0
+        return
+    try:
+        db.execute("PRAGMA optimize")
+        with _WRITE_LOCK:
+            db.execute(
+                "DELETE FROM messages WHERE status = 'delivered' "
+                "AND delivered_at < unixepoch('now') - ?",
+                (MESSAGE_TTL_SECONDS,),
+            )
+            # No-op unless the DB was created with auto_vacuum=INCREMENTAL.
+            # executescript() steps it to completion; execute() stops after
+            # the first step and frees a single page.
+            db.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+    except sqlite3.Error as e:
+        logger.warning(f"Database maintenance failed: {e}")
+
+
+def _close_dbs():
+    """Close every cached connection (atexit)."""
+    with _CONN_LOCK:
+        for db in _CONNS:
+            try:
+                db.execute("PRAGMA optimize")
+                db.close()
+            except sqlite3.Error:
+                pass
+        _CONNS.clear()
+
+
+@contextmanager
+def _write_txn(db: sqlite3.Connection):
+    """Run the block in a BEGIN IMMEDIATE transaction under _WRITE_LOCK.
+
+    Commits on success, rolls back and re-raises on error.
+    """
+    with _WRITE_LOCK:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
 # --- Session Identity ---
 
 
 def _resolve_session_id() -> str:
     """Resolve the current session ID via env var or PID ancestry."""
-    global _cached_session_id
+    global _cached_session_id, _SESSIONS_DIR_MISS_MTIME
     if _cached_session_id is not None:
         return _cached_session_id
 
@@ -114,22 +409,51 @@ def _resolve_session_id() -> str:
         return session_id
 
     # Fallback: scan session state files, match by PID ancestry
-    if os.path.isdir(SESSIONS_DIR):
-        my_pids = _get_pid_ancestry()
-        for fname in os.listdir(SESSIONS_DIR):
-            if not fname.endswith(".json"):
-                continue
-            fpath = os.path.join(SESSIONS_DIR, fname)
-            try:
-                with open(fpath) as f:
-                    state = json.load(f)
-                parent_pid = state.get("parent_pid")
-                if parent_pid and parent_pid in my_pids:
-                    session_id = state["session_id"]
-                    _cached_session_id = session_id
-                    return session_id
-            except (json.JSONDecodeError, OSError, KeyError):
-                continue
+    my_pids = None
+    try:
+        dir_mtime = os.stat(SESSIONS_DIR).st_mtime_ns
+        if dir_mtime == _SESSIONS_DIR_MISS_MTIME:
+            entries = None  # nothing changed since the last miss
+        else:
+            entries = os.scandir(SESSIONS_DIR)
+    except OSError:
+        dir_mtime = entries = None
+    if entries is not None:
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                # {session_id}.{parent_pid}.json: matched on the name alone
+                parts = entry.name.rsplit(".", 2)
+                if len(parts) == 3 and parts[1].isdigit():
+                    if my_pids is None:
+                        my_pids = _get_pid_ancestry()
+                    if int(parts[1]) in my_pids:
+                        _cached_session_id = parts[0]
+                        return parts[0]
+                    continue
+                # Legacy {session_id}.json: parent_pid is in the body
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                    cached = _SESSION_FILE_CACHE.get(entry.name)
+                    if cached and cached[0] == mtime:
+                        state = cached[1]
+                    else:
+                        with open(entry.path) as f:
+                            state = json.load(f)
+                        _SESSION_FILE_CACHE[entry.name] = (mtime, state)
+                    parent_pid = state.get("parent_pid")
+                    if not parent_pid:
+                        continue
+                    if my_pids is None:
+                        my_pids = _get_pid_ancestry()
+                    if parent_pid in my_pids:
+                        session_id = state["session_id"]
+                        _cached_session_id = session_id
+                        return session_id
+                except (json.JSONDecodeError, OSError, KeyError, AttributeError):
+                    continue
+        _SESSIONS_DIR_MISS_MTIME = dir_mtime
 
     raise RuntimeError(
         "Cannot resolve session ID. Set AGENT_NETWORK_SESSION_ID or ensure "
@@ -137,24 +461,61 @@ def _resolve_session_id() -> str:
     )
 
 
+def _get_ppid(pid: int) -> int:
+    """Return the parent of pid without spawning a process where possible.
+
+    Reads /proc on Linux, uses psutil if installed (macOS), and falls back
+    to `ps`. Raises OSError/ValueError if the PID can't be resolved.
+    """
+    if pid == os.getpid():
+        return os.getppid()
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            # comm (field 2) may contain spaces/parens; ppid follows the last ')'
+            return int(f.read().rsplit(b")", 1)[1].split()[1])
+    except FileNotFoundError:
+        pass
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).ppid()
+        except psutil.Error as e:
+            raise OSError(str(e)) from e
+    result = subprocess.run(
+        ["ps", "-o", "ppid=", "-p", str(pid)],
+        capture_output=True,
+        text=True,
+        timeout=2,
+    )
+    return int(result.stdout.strip())
+
+
 def _get_pid_ancestry() -> set[int]:
-    """Walk up the PID tree on macOS and return all ancestor PIDs."""
+    """Walk up the PID tree and return all ancestor PIDs (cached)."""
+    global _PID_ANCESTRY
+    if _PID_ANCESTRY is None:
+        _PID_ANCESTRY = _walk_pid_ancestry()
+    return _PID_ANCESTRY
+
+
+def _walk_pid_ancestry() -> set[int]:
+    """Uncached PID tree walk behind _get_pid_ancestry()."""
+    if psutil is not None and not _HAS_PROC:
+        # No /proc (macOS): psutil walks the whole chain in one call
+        try:
+            me = psutil.Process()
+            return {me.pid, *(p.pid for p in me.parents()), 1}
+        except psutil.Error:
+            pass
     pids = set()
     pid = os.getpid()
     while pid > 1:
         pids.add(pid)
         try:
-            result = subprocess.run(
-                ["ps", "-o", "ppid=", "-p", str(pid)],
-                capture_output=True,
-                text=True,
-                timeout=2,
-            )
-            ppid = int(result.stdout.strip())
+            ppid = _get_ppid(pid)
             if ppid == pid:
                 break
             pid = ppid
-        except (subprocess.TimeoutExpired, ValueError, OSError):
+        except (subprocess.TimeoutExpired, ValueError, OSError, IndexError):
             break
     pids.add(1)
     return pids
@@ -162,21 +523,50 @@ def _get_pid_ancestry() -> set[int]:
 
 def _get_identity() -> tuple[str, str]:
     """Get (agent_id, network_id) for the current session."""
+    global _cached_identity
+    if _cached_identity is not None:
+        return _cached_identity
+
     session_id = _resolve_session_id()
     db = _get_db()
+    row = db.execute(SQL_SELECT_IDENTITY, (session_id,)).fetchone()
+    if not row:
+        raise RuntimeError(
+            f"Session {session_id} is not in any network. "
+            "Call join_network() first."
+        )
+    _cached_identity = (row["agent_id"], row["network_id"])
+    # Sessions joined under an older server have no marker yet
+    _mark_joined(session_id, True)
+    return _cached_identity
+
+
+def _mark_joined(session_id: str, joined: bool):
+    """Create or remove this session's marker in JOINED_DIR.
+
+    A stale marker only costs the Stop hook a DB lookup; a missing one
+    would stop it from nudging, so it's created after every join.
+    """
+    path = os.path.join(JOINED_DIR, session_id)
     try:
-        row = db.execute(
-            "SELECT agent_id, network_id FROM sessions WHERE session_id = ?",
-            (session_id,),
-        ).fetchone()
-        if not row:
-            raise RuntimeError(
-                f"Session {session_id} is not in any network. "
-                "Call join_network() first."
-            )
-        return row["agent_id"], row["network_id"]
-    finally:
-        db.close()
+        if joined:
+            os.makedirs(JOINED_DIR, exist_ok=True)
+            open(path, "a").close()
+        else:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def _heartbeat(db: sqlite3.Connection, session_id: str):
+    """Refresh last_seen (caller holds the write lock).
+
+    If the row is gone (it expired and a new session took over the
+    agent_id), drop the cached identity so the next tool call re-checks.
+    """
+    global _cached_identity
+    if db.execute(SQL_HEARTBEAT, (session_id,)).rowcount == 0:
+        _cached_identity = None
 
 
 def _identity_envelope(data: dict, agent_id: str, network_id: str) -> dict:
@@ -186,15 +576,71 @@ def _identity_envelope(data: dict, agent_id: str, network_id: str) -> dict:
     return data
 
 
+# Audit log lines are serialized by the caller and written by a background
+# thread, so tool calls never wait on the log file
+_LOG_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+_LOG_BATCH_MAX = 128
+_log_thread: threading.Thread | None = None
+_log_thread_lock = threading.Lock()
+
+
+def _log_writer():
+    """Drain _LOG_QUEUE into the audit log until a None sentinel arrives."""
+    f = None
+    while True:
+        lines = [_LOG_QUEUE.get()]
+        while len(lines) < _LOG_BATCH_MAX:
+            try:
+                lines.append(_LOG_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in lines
+        # Encoded here rather than in _append_log, off the tool's path
+        lines = [_dumps(entry) + b"\n" for entry in lines if entry is not None]
+        if lines:
+            try:
+                if f is None:
+                    os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+                    f = open(LOG_PATH, "ab", buffering=64 * 1024)
+                f.write(b"".join(lines))
+                f.flush()
+            except OSError as e:
+                logger.warning(f"Failed to write audit log: {e}")
+                f = None
+        if stop:
+            if f is not None:
+                f.close()
+            return
+
+
+def _stop_log_writer():
+    """Flush queued audit entries before the process exits."""
+    if _log_thread is not None:
+        _LOG_QUEUE.put(None)
+        _log_thread.join(timeout=2)
+
+
 def _append_log(entry: dict):
-    """Append a JSON line to the audit log."""
+    """Queue an entry for the audit log (the caller must not reuse it)."""
+    global _log_thread
+    if not _AUDIT_ENABLED:
+        return
     entry["timestamp"] = time.time()
-    try:
-        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
-        with open(LOG_PATH, "a") as f:
-            f.write(json.dumps(entry) + "\n")
-    except OSError as e:
-        logger.warning(f"Failed to write audit log: {e}")
+    if _log_thread is None:
+        with _log_thread_lock:
+            if _log_thread is None:
+                _log_thread = threading.Thread(
+                    target=_log_writer, name="agent-network-log", daemon=True,
+                )
+                _log_thread.start()
+                atexit.register(_stop_log_writer)
+    _LOG_QUEUE.put(entry)
+
+
+_LISTENER_PATH_QUOTED = shlex.quote(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "hooks", "listener.sh",
+))
+_DB_PATH_QUOTED = shlex.quote(DB_PATH)
 
 
 def _build_listener_command(agent_id: str, network_id: str) -> str:
@@ -206,9 +652,10 @@ def _build_listener_command(agent_id: str, network_id: str) -> str:
     Claude Code only delivers notifications when a background process
     finishes, not on incremental stdout.
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    listener_path = os.path.join(script_dir, "hooks", "listener.sh")
-    return f'bash "{listener_path}" "{agent_id}" "{DB_PATH}" "0" "{network_id}"'
+    return (
+        f"bash {_LISTENER_PATH_QUOTED} {shlex.quote(agent_id)} "
+        f"{_DB_PATH_QUOTED} 0 {shlex.quote(network_id)}"
+    )
 
 
 # --- Peer Helpers ---
@@ -244,16 +691,18 @@ def _http_request(
     headers = {"Content-Type": "application/json"}
     if secret:
         headers["Authorization"] = f"Bearer {secret}"
+        # Lets the peer check our secret against a single row
+        headers["X-Peer-Name"] = _get_machine_name()
 
-    body = json.dumps(data).encode() if data else None
+    body = _dumps(data) if data else None
     req = urllib.request.Request(url, data=body, headers=headers, method=method)
 
     try:
         with urllib.request.urlopen(req, timeout=timeout) as resp:
-            return resp.status, json.loads(resp.read().decode())
+            return resp.status, _loads(resp.read())
     except urllib.error.HTTPError as e:
         try:
-            resp_body = json.loads(e.read().decode())
+            resp_body = _loads(e.read())
         except Exception:
             resp_body = {"error": str(e)}
         return e.code, resp_body
@@ -261,18 +710,34 @@ def _http_request(
         return 0, {"error": f"Connection failed: {e}"}
 
 
-# Peer agent cache: {cache_key: {"agents": [...], "fetched_at": float}}
+# Peer agent cache: {cache_key: {"agents": [...], "fetched_at": float}}.
+# Failed lookups are cached too ("negative"), for a shorter TTL, so an
+# unreachable peer isn't re-dialled on every send.
 _peer_agent_cache: dict = {}
+PEER_CACHE_TTL = 30
+PEER_NEGATIVE_CACHE_TTL = 5
+# Max concurrent requests when fanning out to peers
+PEER_FANOUT_MAX = 8
+# Peer outbox: poll interval, rows claimed per poll, and delivery attempts
+# (with exponential backoff) before a message is dropped
+OUTBOX_POLL_SECONDS = 1
+OUTBOX_BATCH = 20
+OUTBOX_MAX_ATTEMPTS = 5
+# How long a claimed batch stays leased to its process: longer than sending
+# a full batch to slow peers takes, so nobody else picks it up mid-send
+OUTBOX_LEASE_SECONDS = 300
 
 
 def _query_peer_agents(
     peer_name: str, peer_url: str, secret: str, network_id: str,
 ) -> list[dict]:
-    """Get agents from a peer, with 30s caching."""
+    """Get agents from a peer, with 30s caching (5s for failures)."""
     cache_key = f"{peer_name}:{network_id}"
     cached = _peer_agent_cache.get(cache_key)
-    if cached and (time.time() - cached["fetched_at"]) < 30:
-        return cached["agents"]
+    if cached:
+        ttl = PEER_NEGATIVE_CACHE_TTL if cached.get("negative") else PEER_CACHE_TTL
+        if (time.time() - cached["fetched_at"]) < ttl:
+            return cached["agents"]
 
     status, resp = _http_request(
         f"{peer_url}/api/agents?network_id={network_id}",
@@ -282,38 +747,57 @@ def _query_peer_agents(
         agents = resp.get("agents", [])
         _peer_agent_cache[cache_key] = {"agents": agents, "fetched_at": time.time()}
         return agents
+    _peer_agent_cache[cache_key] = {
+        "agents": [], "fetched_at": time.time(), "negative": True,
+    }
     return []
 
 
+def _map_peers(fn, peers: list) -> list:
+    """Call fn(peer) for every peer concurrently, preserving order.
+
+    A call that raises yields None, so one bad peer can't sink the rest.
+    Total latency is the slowest peer rather than the sum.
+    """
+    def call(peer):
+        try:
+            return fn(peer)
+        except Exception:
+            return None
+
+    if len(peers) <= 1:
+        return [call(peer) for peer in peers]
+    with ThreadPoolExecutor(max_workers=min(PEER_FANOUT_MAX, len(peers))) as ex:
+        return list(ex.map(call, peers))
+
+
+def _post_deliver(peer: sqlite3.Row, payload: dict) -> tuple[int, dict]:
+    """POST a message payload to a peer's /api/deliver."""
+    return _http_request(
+        f"{peer['url']}/api/deliver",
+        method="POST",
+        data=payload,
+        secret=peer["shared_secret"],
+    )
+
+
 def _try_send_to_peer(
     sender_id: str, network_id: str, recipient_id: str, content: str,
 ) -> dict | None:
     """Try to deliver a message via approved peers. Returns result dict or None."""
-    db = _get_db()
-    try:
-        peers = db.execute(
-            "SELECT name, url, shared_secret FROM peers "
-            "WHERE status = 'approved' AND direction = 'mutual'"
-        ).fetchall()
-    finally:
-        db.close()
+    peers = _get_db().execute(SQL_APPROVED_PEERS).fetchall()
 
     for peer in peers:
         agents = _query_peer_agents(
             peer["name"], peer["url"], peer["shared_secret"], network_id,
         )
         if any(a.get("agent_id") == recipient_id for a in agents):
-            status, resp = _http_request(
-                f"{peer['url']}/api/deliver",
-                method="POST",
-                data={
-                    "sender_id": sender_id,
-                    "network_id": network_id,
-                    "recipient_id": recipient_id,
-                    "content": content,
-                },
-                secret=peer["shared_secret"],
-            )
+            status, resp = _post_deliver(peer, {
+                "sender_id": sender_id,
+                "network_id": network_id,
+                "recipient_id": recipient_id,
+                "content": content,
+            })
             if status == 200:
                 return {**resp, "status": "sent_to_peer", "peer": peer["name"]}
             elif status != 0:
@@ -322,51 +806,178 @@ def _try_send_to_peer(
                         f"Peer '{peer['name']}' rejected: "
                         f"{resp.get('error', 'unknown')}"
                     ),
+                    "status_code": status,
                 }
     return None
 
 
+_outbox_thread: threading.Thread | None = None
+_outbox_lock = threading.Lock()
+
+
+def _claim_outbox(db: sqlite3.Connection) -> list[sqlite3.Row]:
+    """Lease due rows off the peer outbox.
+
+    Leasing pushes next_attempt_at past the batch's send time, in one write
+    transaction, so several server processes sharing the DB never send the
+    same message. A row is only deleted once it's settled, so one leased
+    by a process that dies mid-send comes due again when the lease ends.
+    """
+    # Most polls find nothing due; a plain read keeps those off the write lock
+    if db.execute(SQL_OUTBOX_DUE).fetchone() is None:
+        return []
+    with _write_txn(db):
+        rows = db.execute(
+            "SELECT * FROM peer_outbox WHERE next_attempt_at <= unixepoch('now') "
+            "ORDER BY id LIMIT ?",
+            (OUTBOX_BATCH,),
+        ).fetchall()
+        if rows:
+            ids = [r["id"] for r in rows]
+            db.execute(
+                "UPDATE peer_outbox SET next_attempt_at = unixepoch('now') + ? "
+                f"WHERE id IN ({','.join('?' * len(ids))})",
+                [OUTBOX_LEASE_SECONDS, *ids],
+            )
+    return rows
+
+
+def _drain_outbox():
+    """Deliver queued peer messages until the process exits."""
+    db = _get_db()
+    while True:
+        try:
+            rows = _claim_outbox(db)
+        except sqlite3.Error as e:
+            logger.warning(f"Peer outbox poll failed: {e}")
+            rows = []
+        for row in rows:
+            try:
+                result = _try_send_to_peer(
+                    row["sender_id"], row["network_id"],
+                    row["recipient_id"], row["content"],
+                )
+            except Exception as e:
+                logger.warning(f"Peer outbox delivery failed: {e}")
+                result = None
+            entry = {
+                "network": row["network_id"],
+                "from": row["sender_id"],
+                "to": row["recipient_id"],
+                "outbox_id": row["id"],
+            }
+            attempts = row["attempts"] + 1
+            if result and "error" not in result:
+                _append_log({"event": "peer_send", "peer": result.get("peer"), **entry})
+                settled = True
+            elif result and not _is_transient(result["status_code"]):
+                # The peer refused the message itself (bad request, auth,
+                # unknown recipient); resending won't change that
+                _append_log({
+                    "event": "peer_outbox_dropped",
+                    "attempts": attempts,
+                    "reason": result["error"],
+                    **entry,
+                })
+                settled = True
+            elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                _append_log({
+                    "event": "peer_outbox_dropped",
+                    "attempts": attempts,
+                    "reason": result["error"] if result else "recipient not found",
+                    **entry,
+                })
+                settled = True
+            else:
+                # Unreachable, busy (5xx) or throttled (429): back off
+                settled = False
+            try:
+                with _WRITE_LOCK:
+                    if settled:
+                        db.execute(
+                            "DELETE FROM peer_outbox WHERE id = ?", (row["id"],),
+                        )
+                    else:
+                        db.execute(
+                            """UPDATE peer_outbox
+                               SET attempts = ?, next_attempt_at = unixepoch('now') + ?
+                               WHERE id = ?""",
+                            (attempts, 2 ** attempts, row["id"]),
+                        )
+            except sqlite3.Error as e:
+                logger.warning(f"Peer outbox update failed: {e}")
+        if not rows:
+            time.sleep(OUTBOX_POLL_SECONDS)
+
+
+def _is_transient(status: int) -> bool:
+    """True for peer HTTP statuses worth retrying (throttled or server-side)."""
+    return status == 429 or status >= 500
+
+
+def _start_outbox_worker():
+    global _outbox_thread
+    with _outbox_lock:
+        if _outbox_thread is None:
+            _outbox_thread = threading.Thread(
+                target=_drain_outbox, name="agent-network-outbox", daemon=True,
+            )
+            _outbox_thread.start()
+
+
 # --- Shared Helpers ---
 
 
 def _fetch_and_deliver(db: sqlite3.Connection, agent_id: str, limit: int = 5) -> dict:
-    """Fetch pending messages and mark as delivered. Returns result dict."""
-    rows = db.execute(
-        """SELECT id, sender_id, content, is_broadcast, created_at
-           FROM messages WHERE recipient_id = ? AND status = 'pending'
-           ORDER BY created_at LIMIT ?""",
-        (agent_id, limit),
-    ).fetchall()
-
-    if not rows:
-        return {"messages": [], "has_more": False, "remaining": 0}
-
-    msg_ids = [r["id"] for r in rows]
-    placeholders = ",".join("?" * len(msg_ids))
-
-    db.execute("BEGIN IMMEDIATE")
-    db.execute(
-        f"UPDATE messages SET status='delivered', delivered_at=unixepoch('now') "
-        f"WHERE id IN ({placeholders}) AND status = 'pending'",
-        msg_ids,
-    )
-    db.execute("COMMIT")
-
-    remaining = db.execute(
-        "SELECT COUNT(*) as cnt FROM messages "
-        "WHERE recipient_id = ? AND status = 'pending'",
-        (agent_id,),
-    ).fetchone()["cnt"]
+    """Fetch pending messages and mark as delivered. Returns result dict.
 
-    # Update last_seen
+    "remaining" is a lower bound capped at limit + 1: enough to say whether
+    there is more and roughly how much, without counting a deep backlog.
+    """
     try:
         session_id = _resolve_session_id()
-        db.execute(
-            "UPDATE sessions SET last_seen = unixepoch('now') WHERE session_id = ?",
-            (session_id,),
-        )
     except RuntimeError:
-        pass
+        session_id = None
+
+    if _HAS_RETURNING:
+        # Empty inbox (most check_inbox calls and wait_for_message wake-ups):
+        # answer from a plain read instead of taking the write lock
+        if not db.execute(SQL_HAS_PENDING, (agent_id,)).fetchone()[0]:
+            return {"messages": [], "has_more": False, "remaining": 0}
+        # Claim and read the batch in one statement. Only rows this call
+        # actually flipped come back, so two processes polling the same
+        # inbox can't both deliver a message. The last_seen refresh rides
+        # in the same commit.
+        with _write_txn(db):
+            rows = db.execute(SQL_CLAIM_PENDING, (agent_id, limit)).fetchall()
+            if rows and session_id is not None:
+                _heartbeat(db, session_id)
+        if not rows:
+            return {"messages": [], "has_more": False, "remaining": 0}
+        # RETURNING order is unspecified
+        rows.sort(key=lambda r: (r["created_at"], r["id"]))
+        msg_ids = [r["id"] for r in rows]
+    else:
+        rows = db.execute(SQL_SELECT_PENDING, (agent_id, limit)).fetchall()
+
+        if not rows:
+            return {"messages": [], "has_more": False, "remaining": 0}
+
+        msg_ids = [r["id"] for r in rows]
+        placeholders = ",".join("?" * len(msg_ids))
+
+        with _write_txn(db):
+            db.execute(
+                f"UPDATE messages SET status='delivered', delivered_at=unixepoch('now') "
+                f"WHERE id IN ({placeholders}) AND status = 'pending'",
+                msg_ids,
+            )
+            if session_id is not None:
+                _heartbeat(db, session_id)
+
+    remaining = db.execute(
+        SQL_PENDING_AT_LEAST, (agent_id, limit + 1),
+    ).fetchone()["cnt"]
 
     messages = []
     for r in rows:
@@ -404,9 +1015,8 @@ def join_network(network_id: str, agent_id: str, role: str = "") -> dict:
         agent_id: Your unique agent name in this network (e.g., "lead", "researcher")
         role: Optional role description (e.g., "code reviewer")
     """
-    import re
-
-    if not re.match(r'^[a-zA-Z0-9_-]+$', agent_id):
+    global _cached_identity
+    if not _ID_RE.match(agent_id):
         return {
             "error": (
                 f"Invalid agent_id '{agent_id}'. "
@@ -416,6 +1026,37 @@ def join_network(network_id: str, agent_id: str, role: str = "") -> dict:
 
     session_id = _resolve_session_id()
     db = _get_db()
+    # LAN collision check + remote agent discovery. Runs before the write
+    # transaction so slow or offline peers never hold the DB write lock.
+    peer_rows = db.execute(SQL_APPROVED_PEERS).fetchall()
+    remote = _map_peers(
+        lambda peer: _query_peer_agents(
+            peer["name"], peer["url"], peer["shared_secret"], network_id,
+        ),
+        peer_rows,
+    )
+    peer_agents: list[dict] = []  # collected for other_agents response
+    for peer, remote_agents in zip(peer_rows, remote):
+        for ra in remote_agents or ():  # None: unreachable peer, skipped
+            if not ra.get("is_active", True):
+                continue
+            if ra.get("agent_id") == agent_id:
+                return {
+                    "error": (
+                        f"Agent ID '{agent_id}' is already taken on "
+                        f"'{peer['name']}' in network '{network_id}'. "
+                        "Choose a different name."
+                    ),
+                }
+            peer_agents.append({
+                "agent_id": ra.get("agent_id", "?"),
+                "role": ra.get("role", ""),
+                "peer": peer["name"],
+            })
+
+    # Held for the whole transaction, including the ROLLBACK in the
+    # except paths below
+    _WRITE_LOCK.acquire()
     try:
         db.execute("BEGIN IMMEDIATE")
 
@@ -441,38 +1082,6 @@ def join_network(network_id: str, agent_id: str, role: str = "") -> dict:
                          "agent_id": agent_id, "old_session": existing["session_id"],
                          "new_session": session_id})
 
-        # LAN collision check + remote agent discovery
-        peer_rows = db.execute(
-            "SELECT name, url, shared_secret FROM peers "
-            "WHERE status = 'approved' AND direction = 'mutual'"
-        ).fetchall()
-        peer_agents: list[dict] = []  # collected for other_agents response
-        for peer in peer_rows:
-            try:
-                remote_agents = _query_peer_agents(
-                    peer["name"], peer["url"],
-                    peer["shared_secret"], network_id,
-                )
-                for ra in remote_agents:
-                    if not ra.get("is_active", True):
-                        continue
-                    if ra.get("agent_id") == agent_id:
-                        db.execute("ROLLBACK")
-                        return {
-                            "error": (
-                                f"Agent ID '{agent_id}' is already taken on "
-                                f"'{peer['name']}' in network '{network_id}'. "
-                                "Choose a different name."
-                            ),
-                        }
-                    peer_agents.append({
-                        "agent_id": ra.get("agent_id", "?"),
-                        "role": ra.get("role", ""),
-                        "peer": peer["name"],
-                    })
-            except Exception:
-                pass  # Skip unreachable peers
-
         db.execute(
             """INSERT INTO sessions (session_id, agent_id, network_id, role)
                VALUES (?, ?, ?, ?)
@@ -499,18 +1108,20 @@ def join_network(network_id: str, agent_id: str, role: str = "") -> dict:
                     "new_agent_id": agent_id,
                     "migrated_count": migrated,
                 })
-        now = time.time()
+        # Active others only, aged against SQLite's clock like last_seen
         others = db.execute(
-            """SELECT agent_id, role, last_seen FROM sessions
-               WHERE network_id = ? AND agent_id != ?""",
-            (network_id, agent_id),
+            """SELECT agent_id, role FROM sessions
+               WHERE network_id = ? AND agent_id != ?
+                 AND last_seen > unixepoch('now') - ?""",
+            (network_id, agent_id, AGENT_EXPIRY_SECONDS),
         ).fetchall()
         db.execute("COMMIT")
+        _cached_identity = (agent_id, network_id)
+        _mark_joined(session_id, True)
 
         agents = [
             {"agent_id": r["agent_id"], "role": r["role"]}
             for r in others
-            if (now - r["last_seen"]) < AGENT_EXPIRY_SECONDS
         ]
         agents.extend(peer_agents)
         return {
@@ -543,32 +1154,39 @@ def join_network(network_id: str, agent_id: str, role: str = "") -> dict:
             pass
         raise
     finally:
-        db.close()
+        _WRITE_LOCK.release()
 
 
 @mcp.tool()
 def leave_network() -> dict:
     """Leave the current agent network. Disconnects from messaging."""
+    global _cached_identity
     agent_id, network_id = _get_identity()
     session_id = _resolve_session_id()
     db = _get_db()
-    try:
-        db.execute("BEGIN IMMEDIATE")
+    with _WRITE_LOCK:
         db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-        db.execute("COMMIT")
-        return {
-            "status": "left",
-            "your_id": agent_id,
-            "network": network_id,
-        }
-    except Exception:
-        try:
-            db.execute("ROLLBACK")
-        except Exception:
-            pass
-        raise
-    finally:
-        db.close()
+    _cached_identity = None
+    _mark_joined(session_id, False)
+    return {
+        "status": "left",
+        "your_id": agent_id,
+        "network": network_id,
+    }
+
+
+def _insert_message_checked(db: sqlite3.Connection, params: tuple) -> int | None:
+    """Run SQL_INSERT_MESSAGE_CHECKED; the new message id, or None if refused."""
+    with _WRITE_LOCK:
+        if _HAS_RETURNING:
+            # A returned row doubles as the "was inserted?" signal.
+            # fetchall() so the statement completes and commits.
+            rows = db.execute(
+                SQL_INSERT_MESSAGE_CHECKED + " RETURNING id", params,
+            ).fetchall()
+            return rows[0][0] if rows else None
+        cursor = db.execute(SQL_INSERT_MESSAGE_CHECKED, params)
+        return cursor.lastrowid if cursor.rowcount else None
 
 
 @mcp.tool()
@@ -594,45 +1212,66 @@ def send_message(to: str, content: str) -> dict:
         )
 
     db = _get_db()
-    try:
+    # Fast path: one auto-commit statement checks and inserts
+    params = (network_id, agent_id, to, content, to, network_id, agent_id, to)
+    msg_id = _insert_message_checked(db, params)
+    if msg_id is None:
+        # Refused; find out which check failed
         recipient = db.execute(
-            "SELECT agent_id FROM sessions WHERE agent_id = ? AND network_id = ?",
-            (to, network_id),
+            SQL_SELECT_LOCAL_AGENT, (to, network_id),
         ).fetchone()
         if not recipient:
-            # Try peer networks
-            peer_result = _try_send_to_peer(agent_id, network_id, to, content)
-            if peer_result:
-                return _identity_envelope(peer_result, agent_id, network_id)
-
-            # Build detailed error with peer check info
-            peer_count = db.execute(
-                "SELECT COUNT(*) as cnt FROM peers "
-                "WHERE status = 'approved' AND direction = 'mutual'"
-            ).fetchone()["cnt"]
-            if peer_count > 0:
-                peer_detail = f" (checked {peer_count} peer(s))"
-            else:
-                peer_detail = " (no peers configured)"
+            peer_count = db.execute(SQL_APPROVED_PEER_COUNT).fetchone()["cnt"]
+            if peer_count == 0:
+                return _identity_envelope(
+                    {
+                        "error": (
+                            f"Agent '{to}' not found in network '{network_id}' "
+                            "(no peers configured). "
+                            "Use list_agents() to see who's online."
+                        ),
+                    },
+                    agent_id,
+                    network_id,
+                )
+
+            # Hand off to the background outbox so slow or offline peers don't
+            # hold up the tool response
+            with _write_txn(db):
+                outbox_id = db.execute(
+                    """INSERT INTO peer_outbox
+                       (network_id, sender_id, recipient_id, content)
+                       VALUES (?, ?, ?, ?)""",
+                    (network_id, agent_id, to, content),
+                ).lastrowid
+            _start_outbox_worker()
+            _append_log({
+                "event": "peer_queue",
+                "network": network_id,
+                "from": agent_id,
+                "to": to,
+                "outbox_id": outbox_id,
+                "content_length": len(content),
+            })
             return _identity_envelope(
                 {
-                    "error": (
-                        f"Agent '{to}' not found in network '{network_id}'"
-                        f"{peer_detail}. "
-                        "Use list_agents() to see who's online."
+                    "status": "queued_to_peers",
+                    "to": to,
+                    "message": (
+                        f"'{to}' is not local; queued for delivery via "
+                        f"{peer_count} peer(s). Use list_agents() to confirm "
+                        "the recipient exists."
                     ),
                 },
                 agent_id,
                 network_id,
             )
 
+        # Unread cap and rate-limit window, counted in one pass
+        counts = db.execute(SQL_PAIR_COUNTS, (agent_id, to)).fetchone()
+
         # Per-sender unread cap (5)
-        unread_count = db.execute(
-            """SELECT COUNT(*) as cnt FROM messages
-               WHERE sender_id = ? AND recipient_id = ? AND status = 'pending'""",
-            (agent_id, to),
-        ).fetchone()["cnt"]
-        if unread_count >= 5:
+        if counts["unread"] >= 5:
             return _identity_envelope(
                 {
                     "error": (
@@ -645,13 +1284,7 @@ def send_message(to: str, content: str) -> dict:
             )
 
         # Per-pair rate limit (10/60s)
-        cutoff = time.time() - 60
-        recent_count = db.execute(
-            """SELECT COUNT(*) as cnt FROM messages
-               WHERE sender_id = ? AND recipient_id = ? AND created_at > ?""",
-            (agent_id, to, cutoff),
-        ).fetchone()["cnt"]
-        if recent_count >= 10:
+        if counts["recent"] >= 10:
             return _identity_envelope(
                 {
                     "error": (
@@ -663,37 +1296,38 @@ def send_message(to: str, content: str) -> dict:
                 network_id,
             )
 
-        db.execute("BEGIN IMMEDIATE")
-        cursor = db.execute(
-            """INSERT INTO messages (network_id, sender_id, recipient_id, content)
-               VALUES (?, ?, ?, ?)""",
-            (network_id, agent_id, to, content),
-        )
-        msg_id = cursor.lastrowid
-        db.execute("COMMIT")
+        # The refusing condition cleared in between (e.g. the recipient
+        # just read their inbox); retry, still through the guarded insert
+        for _ in range(SEND_RETRIES):
+            msg_id = _insert_message_checked(db, params)
+            if msg_id is not None:
+                break
+        else:
+            return _identity_envelope(
+                {
+                    "error": (
+                        f"Could not send to '{to}': the recipient or your "
+                        "message limits changed while sending. Try again."
+                    ),
+                },
+                agent_id,
+                network_id,
+            )
 
-        _append_log({
-            "event": "send",
-            "network": network_id,
-            "from": agent_id,
-            "to": to,
-            "message_id": msg_id,
-            "content_length": len(content),
-        })
+    _append_log({
+        "event": "send",
+        "network": network_id,
+        "from": agent_id,
+        "to": to,
+        "message_id": msg_id,
+        "content_length": len(content),
+    })
 
-        return _identity_envelope(
-            {"status": "sent", "message_id": msg_id, "to": to},
-            agent_id,
-            network_id,
-        )
-    except Exception:
-        try:
-            db.execute("ROLLBACK")
-        except Exception:
-            pass
-        raise
-    finally:
-        db.close()
+    return _identity_envelope(
+        {"status": "sent", "message_id": msg_id, "to": to},
+        agent_id,
+        network_id,
+    )
 
 
 @mcp.tool()
@@ -718,105 +1352,66 @@ def broadcast(content: str) -> dict:
         )
 
     db = _get_db()
-    try:
-        others = db.execute(
-            "SELECT agent_id FROM sessions WHERE network_id = ? AND agent_id != ?",
-            (network_id, agent_id),
-        ).fetchall()
-
-        db.execute("BEGIN IMMEDIATE")
-        sent_count = 0
-        errors = []
-        for row in others:
-            to = row["agent_id"]
-
-            unread_count = db.execute(
-                """SELECT COUNT(*) as cnt FROM messages
-                   WHERE sender_id = ? AND recipient_id = ? AND status = 'pending'""",
-                (agent_id, to),
-            ).fetchone()["cnt"]
-            if unread_count >= 5:
-                errors.append(f"{to}: 5 unread messages pending")
-                continue
-
-            cutoff = time.time() - 60
-            recent_count = db.execute(
-                """SELECT COUNT(*) as cnt FROM messages
-                   WHERE sender_id = ? AND recipient_id = ? AND created_at > ?""",
-                (agent_id, to, cutoff),
-            ).fetchone()["cnt"]
-            if recent_count >= 10:
-                errors.append(f"{to}: rate limit (10/min)")
-                continue
-
-            db.execute(
-                """INSERT INTO messages
-                   (network_id, sender_id, recipient_id, content, is_broadcast)
-                   VALUES (?, ?, ?, ?, 1)""",
-                (network_id, agent_id, to, content),
-            )
-            sent_count += 1
-
-        db.execute("COMMIT")
-
-        # Broadcast to approved peers
-        remote_count = 0
-        peer_rows = db.execute(
-            "SELECT name, url, shared_secret FROM peers "
-            "WHERE status = 'approved' AND direction = 'mutual'"
+    # The blocked-recipient read and the guarded insert share one write
+    # transaction, so nobody can read or send in between and "skipped"
+    # always matches what the insert left out. The read comes first,
+    # before the insert adds to everyone's pending count.
+    with _write_txn(db):
+        blocked = db.execute(
+            SQL_BROADCAST_BLOCKED, (agent_id, network_id, agent_id),
         ).fetchall()
-        for peer in peer_rows:
-            try:
-                status_code, resp = _http_request(
-                    f"{peer['url']}/api/deliver",
-                    method="POST",
-                    data={
-                        "sender_id": agent_id,
-                        "network_id": network_id,
-                        "content": content,
-                        "is_broadcast": True,
-                    },
-                    secret=peer["shared_secret"],
-                )
-                if status_code == 200:
-                    remote_count += resp.get("delivered_count", 0)
-            except Exception:
-                pass
+        # Every local delivery, cap checks included, in one statement
+        sent_count = db.execute(
+            SQL_INSERT_BROADCAST,
+            (agent_id, content, network_id, agent_id, agent_id),
+        ).rowcount
+
+    errors = []
+    for row in blocked:
+        if row["unread"] >= 5:
+            errors.append(f"{row['recipient_id']}: 5 unread messages pending")
+        else:
+            errors.append(f"{row['recipient_id']}: rate limit (10/min)")
+
+    # Broadcast to approved peers
+    remote_count = 0
+    peer_rows = db.execute(SQL_APPROVED_PEERS).fetchall()
+    payload = {
+        "sender_id": agent_id,
+        "network_id": network_id,
+        "content": content,
+        "is_broadcast": True,
+    }
+    for result in _map_peers(lambda peer: _post_deliver(peer, payload), peer_rows):
+        if result and result[0] == 200:
+            remote_count += result[1].get("delivered_count", 0)
 
-        total = sent_count + remote_count
-        if total == 0 and not errors:
-            return _identity_envelope(
-                {
-                    "status": "no_recipients",
-                    "message": "No other agents in the network to broadcast to.",
-                },
-                agent_id,
-                network_id,
-            )
+    total = sent_count + remote_count
+    if total == 0 and not errors:
+        return _identity_envelope(
+            {
+                "status": "no_recipients",
+                "message": "No other agents in the network to broadcast to.",
+            },
+            agent_id,
+            network_id,
+        )
 
-        _append_log({
-            "event": "broadcast",
-            "network": network_id,
-            "from": agent_id,
-            "recipient_count": sent_count,
-            "remote_count": remote_count,
-            "content_length": len(content),
-        })
+    _append_log({
+        "event": "broadcast",
+        "network": network_id,
+        "from": agent_id,
+        "recipient_count": sent_count,
+        "remote_count": remote_count,
+        "content_length": len(content),
+    })
 
-        result = {"status": "broadcast_sent", "recipient_count": sent_count}
-        if remote_count > 0:
-            result["remote_count"] = remote_count
-        if errors:
-            result["skipped"] = errors
-        return _identity_envelope(result, agent_id, network_id)
-    except Exception:
-        try:
-            db.execute("ROLLBACK")
-        except Exception:
-            pass
-        raise
-    finally:
-        db.close()
+    result = {"status": "broadcast_sent", "recipient_count": sent_count}
+    if remote_count > 0:
+        result["remote_count"] = remote_count
+    if errors:
+        result["skipped"] = errors
+    return _identity_envelope(result, agent_id, network_id)
 
 
 @mcp.tool()
@@ -824,11 +1419,8 @@ def check_inbox() -> dict:
     """Check for pending messages. Returns up to 5 messages, marks them delivered."""
     agent_id, network_id = _get_identity()
     db = _get_db()
-    try:
-        result = _fetch_and_deliver(db, agent_id, limit=5)
-        return _identity_envelope(result, agent_id, network_id)
-    finally:
-        db.close()
+    result = _fetch_and_deliver(db, agent_id, limit=5)
+    return _identity_envelope(result, agent_id, network_id)
 
 
 @mcp.tool()
@@ -847,42 +1439,41 @@ async def wait_for_message(timeout: int = 30) -> dict:
 
     agent_id, network_id = _get_identity()
 
+    db = _get_db()
     deadline = time.time() + timeout
+    next_heartbeat = 0.0
+    last_version = None
     while True:
-        db = _get_db()
-        try:
-            count = db.execute(
-                "SELECT COUNT(*) as cnt FROM messages "
-                "WHERE recipient_id = ? AND status = 'pending'",
-                (agent_id,),
-            ).fetchone()["cnt"]
-
-            if count > 0:
-                result = _fetch_and_deliver(db, agent_id, limit=5)
+        # data_version changes whenever another connection commits to the
+        # file (senders are other processes, so an in-process notifier
+        # wouldn't see them); only then is a fetch worth running
+        version = db.execute("PRAGMA data_version").fetchone()[0]
+        if version != last_version:
+            last_version = version
+            # The fetch doubles as the "anything pending?" check
+            result = _fetch_and_deliver(db, agent_id, limit=5)
+            if result["messages"]:
                 return _identity_envelope(result, agent_id, network_id)
 
-            # Heartbeat
+        now = time.time()
+        if now >= next_heartbeat:
+            # _fetch_and_deliver only refreshes it when it delivers
+            next_heartbeat = now + WAIT_HEARTBEAT_SECONDS
             try:
                 session_id = _resolve_session_id()
-                db.execute(
-                    "UPDATE sessions SET last_seen = unixepoch('now') "
-                    "WHERE session_id = ?",
-                    (session_id,),
-                )
+                with _WRITE_LOCK:
+                    _heartbeat(db, session_id)
             except RuntimeError:
                 pass
-        finally:
-            db.close()
 
-        if time.time() >= deadline:
+        if now >= deadline:
             return _identity_envelope(
                 {"status": "timeout", "messages": [], "waited": timeout},
                 agent_id,
                 network_id,
             )
 
-        remaining = deadline - time.time()
-        await asyncio.sleep(min(2, max(0, remaining)))
+        await asyncio.sleep(min(WAIT_POLL_SECONDS, deadline - now))
 
 
 @mcp.tool()
@@ -890,66 +1481,47 @@ def list_agents() -> dict:
     """List all agents in your network with their roles and last activity."""
     agent_id, network_id = _get_identity()
     db = _get_db()
-    try:
-        rows = db.execute(
-            """SELECT agent_id, role, last_seen FROM sessions
-               WHERE network_id = ?""",
-            (network_id,),
-        ).fetchall()
-
-        now = time.time()
-        agents = []
-        for r in rows:
+    # Age, liveness and is_you are computed by SQLite
+    agents = _loads(db.execute(
+        SQL_NETWORK_AGENTS_JSON, (AGENT_EXPIRY_SECONDS, agent_id, network_id),
+    ).fetchone()[0])
+
+    # Query approved peers for remote agents
+    peer_rows = db.execute(SQL_APPROVED_PEERS).fetchall()
+    remote = _map_peers(
+        lambda peer: _query_peer_agents(
+            peer["name"], peer["url"], peer["shared_secret"], network_id,
+        ),
+        peer_rows,
+    )
+    for peer, remote_agents in zip(peer_rows, remote):
+        for ra in remote_agents or ():  # None: unreachable peer, skipped
             agents.append({
-                "agent_id": r["agent_id"],
-                "role": r["role"],
-                "last_seen_seconds_ago": round(now - r["last_seen"]),
-                "is_active": (now - r["last_seen"]) < AGENT_EXPIRY_SECONDS,
-                "is_you": r["agent_id"] == agent_id,
+                "agent_id": ra.get("agent_id", "?"),
+                "role": ra.get("role", ""),
+                "peer": peer["name"],
+                "is_you": False,
+                "is_active": ra.get("is_active", True),
             })
 
-        # Query approved peers for remote agents
-        peer_rows = db.execute(
-            "SELECT name, url, shared_secret FROM peers "
-            "WHERE status = 'approved' AND direction = 'mutual'"
-        ).fetchall()
-        for peer in peer_rows:
-            try:
-                remote_agents = _query_peer_agents(
-                    peer["name"], peer["url"],
-                    peer["shared_secret"], network_id,
-                )
-                for ra in remote_agents:
-                    agents.append({
-                        "agent_id": ra.get("agent_id", "?"),
-                        "role": ra.get("role", ""),
-                        "peer": peer["name"],
-                        "is_you": False,
-                        "is_active": ra.get("is_active", True),
-                    })
-            except Exception:
-                pass  # Skip unreachable peers
-
-        # Detect duplicate agent_ids across local and remote
-        warnings = []
-        seen_ids: dict[str, list[str]] = {}
-        for a in agents:
-            aid = a["agent_id"]
-            source = a.get("peer", "local")
-            seen_ids.setdefault(aid, []).append(source)
-        for aid, sources in seen_ids.items():
-            if len(sources) > 1:
-                warnings.append(
-                    f"Agent ID '{aid}' appears on multiple machines: "
-                    f"{', '.join(sources)}"
-                )
+    # Detect duplicate agent_ids across local and remote
+    warnings = []
+    seen_ids: dict[str, list[str]] = {}
+    for a in agents:
+        aid = a["agent_id"]
+        source = a.get("peer", "local")
+        seen_ids.setdefault(aid, []).append(source)
+    for aid, sources in seen_ids.items():
+        if len(sources) > 1:
+            warnings.append(
+                f"Agent ID '{aid}' appears on multiple machines: "
+                f"{', '.join(sources)}"
+            )
 
-        result = {"agents": agents, "count": len(agents)}
-        if warnings:
-            result["warnings"] = warnings
-        return _identity_envelope(result, agent_id, network_id)
-    finally:
-        db.close()
+    result = {"agents": agents, "count": len(agents)}
+    if warnings:
+        result["warnings"] = warnings
+    return _identity_envelope(result, agent_id, network_id)
 
 
 # --- Peer MCP Tools ---
@@ -964,8 +1536,6 @@ def pair_with(url: str, name: str, secret: str = "") -> dict:
         name: A friendly name for this peer (e.g., "work-laptop")
         secret: Optional shared secret for authentication
     """
-    import re
-
     local_url = _get_local_url()
     if not local_url:
         return {
@@ -975,7 +1545,7 @@ def pair_with(url: str, name: str, secret: str = "") -> dict:
             ),
         }
 
-    if not re.match(r'^[a-zA-Z0-9_-]+$', name):
+    if not _ID_RE.match(name):
         return {
             "error": (
                 f"Invalid peer name '{name}'. "
@@ -984,14 +1554,13 @@ def pair_with(url: str, name: str, secret: str = "") -> dict:
         }
 
     db = _get_db()
-    try:
-        existing = db.execute(
-            "SELECT status, direction FROM peers WHERE name = ?", (name,),
-        ).fetchone()
-        if existing and existing["direction"] == "mutual":
-            return {"error": f"Already paired with '{name}'."}
+    existing = db.execute(
+        "SELECT status, direction FROM peers WHERE name = ?", (name,),
+    ).fetchone()
+    if existing and existing["direction"] == "mutual":
+        return {"error": f"Already paired with '{name}'."}
 
-        db.execute("BEGIN IMMEDIATE")
+    with _write_txn(db):
         db.execute(
             """INSERT INTO peers (name, url, shared_secret, status, direction)
                VALUES (?, ?, ?, 'pending', 'outbound')
@@ -1000,52 +1569,43 @@ def pair_with(url: str, name: str, secret: str = "") -> dict:
                    status='pending', direction='outbound'""",
             (name, url, secret),
         )
-        db.execute("COMMIT")
 
-        # Notify remote
-        status_code, resp = _http_request(
-            f"{url}/api/pair/request",
-            method="POST",
-            data={
-                "name": _get_machine_name(),
-                "url": local_url,
-                "secret": secret,
-            },
-            secret=secret,
-        )
+    # Notify remote
+    status_code, resp = _http_request(
+        f"{url}/api/pair/request",
+        method="POST",
+        data={
+            "name": _get_machine_name(),
+            "url": local_url,
+            "secret": secret,
+        },
+        secret=secret,
+    )
 
-        if status_code == 0:
-            return {
-                "status": "pending",
-                "peer": name,
-                "warning": (
-                    f"Could not reach {url}. Pairing request saved locally — "
-                    "retry when remote is online."
-                ),
-            }
-        elif status_code == 200:
-            return {
-                "status": "pending",
-                "peer": name,
-                "message": "Pairing request sent. Waiting for remote approval.",
-            }
-        else:
-            return {
-                "status": "pending",
-                "peer": name,
-                "warning": (
-                    f"Remote returned {status_code}: "
-                    f"{resp.get('error', 'unknown')}"
-                ),
-            }
-    except Exception:
-        try:
-            db.execute("ROLLBACK")
-        except Exception:
-            pass
-        raise
-    finally:
-        db.close()
+    if status_code == 0:
+        return {
+            "status": "pending",
+            "peer": name,
+            "warning": (
+                f"Could not reach {url}. Pairing request saved locally — "
+                "retry when remote is online."
+            ),
+        }
+    elif status_code == 200:
+        return {
+            "status": "pending",
+            "peer": name,
+            "message": "Pairing request sent. Waiting for remote approval.",
+        }
+    else:
+        return {
+            "status": "pending",
+            "peer": name,
+            "warning": (
+                f"Remote returned {status_code}: "
+                f"{resp.get('error', 'unknown')}"
+            ),
+        }
 
 
 @mcp.tool()
@@ -1056,102 +1616,72 @@ def approve_peer(peer_id: str) -> dict:
         peer_id: The name of the peer to approve
     """
     db = _get_db()
-    try:
-        peer = db.execute(
-            "SELECT name, url, shared_secret, status, direction FROM peers "
-            "WHERE name = ?",
-            (peer_id,),
-        ).fetchone()
+    peer = db.execute(
+        "SELECT name, url, shared_secret, status, direction FROM peers "
+        "WHERE name = ?",
+        (peer_id,),
+    ).fetchone()
 
-        if not peer:
-            return {
-                "error": (
-                    f"Peer '{peer_id}' not found. "
-                    "Use list_peers() to see pending requests."
-                ),
-            }
+    if not peer:
+        return {
+            "error": (
+                f"Peer '{peer_id}' not found. "
+                "Use list_peers() to see pending requests."
+            ),
+        }
 
-        if peer["direction"] == "mutual" and peer["status"] == "approved":
-            return {"error": f"Peer '{peer_id}' is already approved."}
+    if peer["direction"] == "mutual" and peer["status"] == "approved":
+        return {"error": f"Peer '{peer_id}' is already approved."}
 
-        if peer["status"] != "pending":
-            return {
-                "error": (
-                    f"Peer '{peer_id}' is not pending "
-                    f"(status: {peer['status']})."
-                ),
-            }
+    if peer["status"] != "pending":
+        return {
+            "error": (
+                f"Peer '{peer_id}' is not pending "
+                f"(status: {peer['status']})."
+            ),
+        }
 
-        db.execute("BEGIN IMMEDIATE")
+    with _write_txn(db):
         db.execute(
             "UPDATE peers SET status = 'approved', direction = 'mutual', "
             "last_seen = unixepoch('now') WHERE name = ?",
             (peer_id,),
         )
-        db.execute("COMMIT")
 
-        # Notify remote — include our local URL so the peer can look us up
-        # even if the name we send doesn't match what they stored
-        local_url = _get_local_url() or ""
-        status_code, _resp = _http_request(
-            f"{peer['url']}/api/pair/accept",
-            method="POST",
-            data={"name": _get_machine_name(), "url": local_url, "secret": peer["shared_secret"]},
-            secret=peer["shared_secret"],
-        )
+    # Notify remote — include our local URL so the peer can look us up
+    # even if the name we send doesn't match what they stored
+    local_url = _get_local_url() or ""
+    status_code, _resp = _http_request(
+        f"{peer['url']}/api/pair/accept",
+        method="POST",
+        data={"name": _get_machine_name(), "url": local_url, "secret": peer["shared_secret"]},
+        secret=peer["shared_secret"],
+    )
 
-        if status_code == 0:
-            # Revert to pending if can't reach
-            db.execute("BEGIN IMMEDIATE")
+    if status_code == 0:
+        # Revert to pending if can't reach
+        with _write_txn(db):
             db.execute(
                 "UPDATE peers SET status = 'pending', direction = 'inbound' "
                 "WHERE name = ?",
                 (peer_id,),
             )
-            db.execute("COMMIT")
-            return {
-                "error": (
-                    f"Could not reach peer '{peer_id}' at {peer['url']}. "
-                    "Reverted to pending."
-                ),
-            }
+        return {
+            "error": (
+                f"Could not reach peer '{peer_id}' at {peer['url']}. "
+                "Reverted to pending."
+            ),
+        }
 
-        _append_log({"event": "peer_approved", "peer": peer_id})
-        return {"status": "approved", "peer": peer_id, "url": peer["url"]}
-    except Exception:
-        try:
-            db.execute("ROLLBACK")
-        except Exception:
-            pass
-        raise
-    finally:
-        db.close()
+    _append_log({"event": "peer_approved", "peer": peer_id})
+    return {"status": "approved", "peer": peer_id, "url": peer["url"]}
 
 
 @mcp.tool()
 def list_peers() -> dict:
     """List all configured peers and their connection status."""
-    db = _get_db()
-    try:
-        rows = db.execute(
-            "SELECT name, url, status, direction, last_seen, created_at "
-            "FROM peers ORDER BY created_at"
-        ).fetchall()
-
-        peers = []
-        for r in rows:
-            peers.append({
-                "name": r["name"],
-                "url": r["url"],
-                "status": r["status"],
-                "direction": r["direction"],
-                "last_seen": r["last_seen"],
-                "created_at": r["created_at"],
-            })
-
-        return {"peers": peers, "count": len(peers)}
-    finally:
-        db.close()
+    peers = _loads(_get_db().execute(SQL_PEERS_JSON).fetchone()[0])
+    return {"peers": peers, "count": len(peers)}
 
 
 @mcp.tool()
@@ -1161,32 +1691,23 @@ def remove_peer(peer_id: str) -> dict:
     Args:
         peer_id: The name of the peer to remove
     """
+    # A single autocommit DELETE; rowcount 0 means there was no such peer
     db = _get_db()
-    try:
-        existing = db.execute(
-            "SELECT name FROM peers WHERE name = ?", (peer_id,),
-        ).fetchone()
-        if not existing:
-            return {"error": f"Peer '{peer_id}' not found."}
-
-        db.execute("BEGIN IMMEDIATE")
-        db.execute("DELETE FROM peers WHERE name = ?", (peer_id,))
-        db.execute("COMMIT")
+    with _WRITE_LOCK:
+        deleted = db.execute(
+            "DELETE FROM peers WHERE name = ?", (peer_id,),
+        ).rowcount
+    if not deleted:
+        return {"error": f"Peer '{peer_id}' not found."}
 
-        _append_log({"event": "peer_removed", "peer": peer_id})
-        return {"status": "removed", "peer": peer_id}
-    except Exception:
-        try:
-            db.execute("ROLLBACK")
-        except Exception:
-            pass
-        raise
-    finally:
-        db.close()
+    _append_log({"event": "peer_removed", "peer": peer_id})
+    return {"status": "removed", "peer": peer_id}
 
 
 # --- Entry Point ---
 
 if __name__ == "__main__":
     init_db()
+    # Picks up anything a previous process queued but didn't deliver
+    _start_outbox_worker()
     mcp.run()
@@ -13,17 +13,135 @@ import sys
 import time
 
 SESSIONS_DIR = os.path.expanduser("~/.claude/agent_network/sessions")
+JOINED_DIR = os.path.expanduser("~/.claude/agent_network/joined")
 DB_PATH = os.environ.get(
     "AGENT_NETWORK_DB", os.path.expanduser("~/.claude/agent_network.db")
 )
 MESSAGE_TTL_SECONDS = 7 * 24 * 3600  # 7 days
+# The purge's mtime stamp; sessions starting within a day of it skip the DELETE
+PURGE_STAMP = os.path.expanduser("~/.claude/agent_network/.last_purge")
+PURGE_INTERVAL = 24 * 3600
+
+
+def _detach() -> bool:
+    """Fork the housekeeping into a child so the hook returns right away.
+
+    Claude Code waits for the hook process (and its stdout) to finish, so
+    the child starts its own session and lets go of stdio. Returns True
+    where the cleanup should run: in the child, or inline if fork isn't
+    available. The parent gets False and exits.
+    """
+    if not hasattr(os, "fork"):
+        return True
+    try:
+        if os.fork() > 0:
+            return False
+    except OSError:
+        return True
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    return True
+
+
+def _cleanup(session_id: str, state_name: str):
+    """Drop stale session state files and purge old delivered messages.
+
+    Also prunes the stop hook's joined markers for sessions with no live
+    state file, and restores the marker for a resumed session that is
+    still in a network.
+    """
+    # Clean stale state files (PIDs that no longer exist), noting which
+    # sessions are still alive
+    live = {session_id}
+    try:
+        with os.scandir(SESSIONS_DIR) as entries:
+            for entry in entries:
+                fname = entry.name
+                if not fname.endswith(".json") or fname == state_name:
+                    continue
+                parts = fname.rsplit(".", 2)
+                try:
+                    if fname.startswith(f"{session_id}."):
+                        # Superseded by the file just written
+                        raise ProcessLookupError
+                    if len(parts) == 3 and parts[1].isdigit():
+                        pid = int(parts[1])
+                    else:
+                        # Legacy {session_id}.json: PID only in the body
+                        with open(entry.path) as f:
+                            pid = json.load(f).get("parent_pid")
+                    if pid:
+                        os.kill(pid, 0)  # Check if process exists
+                except (ProcessLookupError, PermissionError):
+                    # PID doesn't exist or we can't signal it — stale
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                except (json.JSONDecodeError, OSError, TypeError, AttributeError):
+                    pass
+                live.add(parts[0] if len(parts) == 3 else fname[:-5])
+    except OSError:
+        live = None  # Unknown; leave every marker alone
+
+    # Sessions that ended without leave_network() leave their marker behind
+    if live is not None:
+        try:
+            with os.scandir(JOINED_DIR) as entries:
+                for entry in entries:
+                    if entry.name not in live:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+        except OSError:
+            pass
+
+    # Purge delivered messages older than 7 days, at most once a day
+    try:
+        purge_due = time.time() - os.path.getmtime(PURGE_STAMP) > PURGE_INTERVAL
+    except OSError:
+        purge_due = True
+    if os.path.exists(DB_PATH):
+        try:
+            import sqlite3
+            db = sqlite3.connect(DB_PATH, isolation_level=None)
+            db.execute("PRAGMA busy_timeout=5000")
+            if purge_due:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute(
+                    "DELETE FROM messages WHERE status = 'delivered' "
+                    "AND delivered_at < (unixepoch('now') - ?)",
+                    (MESSAGE_TTL_SECONDS,),
+                )
+                db.execute("COMMIT")
+                open(PURGE_STAMP, "w").close()
+            joined = db.execute(
+                "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,),
+            ).fetchone()
+            db.close()
+            if joined:
+                os.makedirs(JOINED_DIR, exist_ok=True)
+                open(os.path.join(JOINED_DIR, session_id), "a").close()
+        except Exception:
+            pass
+
+
+def _emit(output: dict):
+    """Write the hook's JSON reply to stdout as compact bytes, flushed now."""
+    out = sys.stdout.buffer
+    out.write(json.dumps(output, separators=(",", ":")).encode() + b"\n")
+    out.flush()
 
 
 def main():
-    raw = sys.stdin.read()
+    # Decoded straight from the bytes; ValueError also covers bad UTF-8
     try:
-        data = json.loads(raw)
-    except json.JSONDecodeError:
+        data = json.load(sys.stdin.buffer)
+    except ValueError:
         return
 
     session_id = data.get("session_id")
@@ -50,60 +168,31 @@ def main():
         "parent_pid": os.getppid(),
         "created_at": time.time(),
     }
-    state_path = os.path.join(SESSIONS_DIR, f"{session_id}.json")
+    # The parent PID is also in the name ({session_id}.{ppid}.json) so the
+    # _cleanup() sweep and the MCP server's lookup never open the file
+    state_name = f"{session_id}.{state['parent_pid']}.json"
+    state_path = os.path.join(SESSIONS_DIR, state_name)
     try:
-        with open(state_path, "w") as f:
+        # Write-then-rename: readers never see a partial file, and every
+        # write bumps the directory mtime the MCP server's scan cache keys on
+        tmp_path = f"{state_path}.tmp"
+        with open(tmp_path, "w") as f:
             json.dump(state, f)
+        os.replace(tmp_path, state_path)
     except OSError:
         pass
 
-    # Clean stale state files (PIDs that no longer exist)
-    try:
-        for fname in os.listdir(SESSIONS_DIR):
-            if not fname.endswith(".json") or fname == f"{session_id}.json":
-                continue
-            fpath = os.path.join(SESSIONS_DIR, fname)
-            try:
-                with open(fpath) as f:
-                    old_state = json.load(f)
-                pid = old_state.get("parent_pid")
-                if pid:
-                    os.kill(pid, 0)  # Check if process exists
-            except (ProcessLookupError, PermissionError):
-                # PID doesn't exist or we can't signal it — stale
-                try:
-                    os.remove(fpath)
-                except OSError:
-                    pass
-            except (json.JSONDecodeError, OSError, TypeError):
-                pass
-    except OSError:
-        pass
-
-    # Purge delivered messages older than 7 days
-    if os.path.exists(DB_PATH):
-        try:
-            import sqlite3
-            db = sqlite3.connect(DB_PATH, isolation_level=None)
-            db.execute("PRAGMA busy_timeout=5000")
-            db.execute("BEGIN IMMEDIATE")
-            db.execute(
-                "DELETE FROM messages WHERE status = 'delivered' "
-                "AND delivered_at < (unixepoch('now') - ?)",
-                (MESSAGE_TTL_SECONDS,),
-            )
-            db.execute("COMMIT")
-            db.close()
-        except Exception:
-            pass
-
     output = {
         "hookSpecificOutput": {
             "hookEventName": "SessionStart",
             "additionalContext": "Agent network session initialized.",
         }
     }
-    print(json.dumps(output))
+    _emit(output)
+
+    # Housekeeping nobody waits on runs after the output is out
+    if _detach():
+        _cleanup(session_id, state_name)
 
 
 if __name__ == "__main__":
@@ -8,14 +8,21 @@ Two checks at every turn boundary:
 No external dependencies — stdlib only.
 """
 
-import json
 import os
-import subprocess
 import sys
 
 DB_PATH = os.environ.get(
     "AGENT_NETWORK_DB", os.path.expanduser("~/.claude/agent_network.db")
 )
+# The MCP server keeps an empty file here for each session in a network
+JOINED_DIR = os.path.expanduser("~/.claude/agent_network/joined")
+
+# Identity and unread count in one statement: a hook process runs each
+# query once, so fewer statements is what saves SQL parsing here
+SQL_IDENTITY_PENDING = """SELECT agent_id, network_id,
+          (SELECT COUNT(*) FROM messages
+           WHERE recipient_id = s.agent_id AND status = 'pending') AS pending
+   FROM sessions s WHERE session_id = ?"""
 
 
 def _is_listener_running(agent_id: str) -> bool:
@@ -25,6 +32,8 @@ def _is_listener_running(agent_id: str) -> bool:
     (e.g. agent "al" matching agent "alice"'s listener). The agent_id is
     always followed by the db_path argument, so trailing space is safe.
     """
+    import subprocess
+
     try:
         result = subprocess.run(
             ["pgrep", "-fl", "listener.sh"],
@@ -37,23 +46,40 @@ def _is_listener_running(agent_id: str) -> bool:
         return True  # Assume running if we can't check
 
 
+def _emit(output: dict):
+    """Write the hook's JSON reply to stdout as compact bytes, flushed now."""
+    import json  # already loaded by main()
+
+    out = sys.stdout.buffer
+    out.write(json.dumps(output, separators=(",", ":")).encode() + b"\n")
+    out.flush()
+
+
 def main():
     # Fast-exit: no DB means agent network has never been used
     if not os.path.exists(DB_PATH):
         return
 
-    import sqlite3
+    # Imported after the fast exit
+    import json
 
-    raw = sys.stdin.read()
+    # Decoded straight from the bytes; ValueError also covers bad UTF-8
     try:
-        data = json.loads(raw)
-    except json.JSONDecodeError:
+        data = json.load(sys.stdin.buffer)
+    except ValueError:
         return
 
     session_id = data.get("session_id")
     if not session_id:
         return
 
+    # No marker: this session never joined (or has left), so there is
+    # nothing to check in the DB
+    if not os.path.exists(os.path.join(JOINED_DIR, session_id)):
+        return
+
+    import sqlite3
+
     try:
         db = sqlite3.connect(DB_PATH, isolation_level=None)
         db.execute("PRAGMA busy_timeout=5000")
@@ -63,22 +89,14 @@ def main():
 
     try:
         # Look up agent identity
-        row = db.execute(
-            "SELECT agent_id, network_id FROM sessions WHERE session_id = ?",
-            (session_id,),
-        ).fetchone()
+        row = db.execute(SQL_IDENTITY_PENDING, (session_id,)).fetchone()
         if not row:
             return
         agent_id = row["agent_id"]
         network_id = row["network_id"]
 
         # Priority 1: block if there are unread messages
-        pending = db.execute(
-            "SELECT COUNT(*) as cnt FROM messages "
-            "WHERE recipient_id = ? AND status = 'pending'",
-            (agent_id,),
-        ).fetchone()["cnt"]
-
+        pending = row["pending"]
         if pending > 0:
             output = {
                 "decision": "block",
@@ -87,16 +105,19 @@ def main():
                     "Call check_inbox() to receive them."
                 ),
             }
-            print(json.dumps(output))
+            _emit(output)
             return
 
         # Priority 2: block if background listener isn't running
         if not _is_listener_running(agent_id):
+            import shlex
+
             hooks_dir = os.path.dirname(os.path.abspath(__file__))
             listener_path = os.path.join(hooks_dir, "listener.sh")
+            # Quoted the same way as the server's _build_listener_command
             listener_cmd = (
-                f'bash "{listener_path}" "{agent_id}" '
-                f'"{DB_PATH}" "0" "{network_id}"'
+                f"bash {shlex.quote(listener_path)} {shlex.quote(agent_id)} "
+                f"{shlex.quote(DB_PATH)} 0 {shlex.quote(network_id)}"
             )
             output = {
                 "decision": "block",
@@ -106,7 +127,7 @@ def main():
                     f"(run_in_background=true):\n{listener_cmd}"
                 ),
             }
-            print(json.dumps(output))
+            _emit(output)
             return
 
     except sqlite3.Error:
@@ -1,44 +1,67 @@
 #!/usr/bin/env python3
 """View agent network message history as a formatted chat log."""
 
-import argparse
+import os
 import sqlite3
 import sys
 import time
-from datetime import datetime, timezone
-from pathlib import Path
+from collections.abc import Iterable, Iterator
+from itertools import chain
 
-DB_PATH = Path.home() / ".claude" / "agent_network.db"
+# A plain string: pathlib alone is ~13ms of imports for two exists() calls
+DB_PATH = os.path.expanduser("~/.claude/agent_network.db")
+
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+           "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
 
 
 def parse_duration(s: str) -> float:
     """Parse a duration string like '30m', '2h', '1d' into seconds."""
-    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
     if not s:
         return 0
-    unit = s[-1].lower()
-    if unit in units:
+    scale = _DURATION_UNITS.get(s[-1].lower())
+    if scale is not None:
         try:
-            return float(s[:-1]) * units[unit]
+            return float(s[:-1]) * scale
         except ValueError:
             pass
     raise ValueError(f"Invalid duration: {s!r} (use e.g. 30m, 2h, 1d)")
 
 
 def format_timestamp(unix_ts: float) -> str:
-    """Format a unix timestamp as a readable local time string."""
-    dt = datetime.fromtimestamp(unix_ts, tz=timezone.utc).astimezone()
-    return dt.strftime("%b %d, %I:%M %p").replace(" 0", " ")
+    """Format a unix timestamp as a readable local time string.
 
+    Built from time.localtime() fields: this runs once per rendered
+    message, and datetime + strftime cost several times as much.
+    """
+    tm = time.localtime(unix_ts)
+    hour = tm.tm_hour % 12 or 12
+    ampm = "AM" if tm.tm_hour < 12 else "PM"
+    return f"{_MONTHS[tm.tm_mon - 1]} {tm.tm_mday}, {hour}:{tm.tm_min:02d} {ampm}"
 
-def list_networks() -> list[dict]:
-    """List all networks with agent counts and last activity."""
-    if not DB_PATH.exists():
+
+def _connect() -> sqlite3.Connection:
+    """Open the DB read-only, exiting if it doesn't exist.
+
+    Same cache and mmap sizes as the MCP server's connections, so long
+    history scans read mapped pages instead of issuing a pread() per page.
+    """
+    if not os.path.exists(DB_PATH):
         print("No agent network database found at", DB_PATH, file=sys.stderr)
         sys.exit(1)
 
     conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
     conn.row_factory = sqlite3.Row
+    return conn
+
+
+def list_networks() -> list[dict]:
+    """List all networks with agent counts and last activity."""
+    conn = _connect()
     try:
         rows = conn.execute("""
             SELECT
@@ -76,14 +99,13 @@ def fetch_messages(
     network_id: str,
     since_seconds: float = 0,
     agent_filter: str | None = None,
-) -> list[dict]:
-    """Fetch messages from the DB for a given network."""
-    if not DB_PATH.exists():
-        print("No agent network database found at", DB_PATH, file=sys.stderr)
-        sys.exit(1)
+) -> Iterator[sqlite3.Row]:
+    """Yield messages from the DB for a given network, oldest first.
 
-    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
-    conn.row_factory = sqlite3.Row
+    Rows stream straight off the cursor; the connection closes once the
+    caller has consumed (or dropped) the generator.
+    """
+    conn = _connect()
     try:
         query = """
             SELECT sender_id, recipient_id, content, is_broadcast, created_at
@@ -93,9 +115,8 @@ def fetch_messages(
         params: list = [network_id]
 
         if since_seconds > 0:
-            cutoff = time.time() - since_seconds
-            query += " AND created_at >= ?"
-            params.append(cutoff)
+            query += " AND created_at >= unixepoch('now') - ?"
+            params.append(since_seconds)
 
         if agent_filter:
             query += " AND (sender_id = ? OR recipient_id = ?)"
@@ -103,20 +124,25 @@ def fetch_messages(
 
         query += " ORDER BY created_at ASC"
 
-        rows = conn.execute(query, params).fetchall()
-        return [dict(r) for r in rows]
+        yield from conn.execute(query, params)
     finally:
         conn.close()
 
 
-def render_chat(messages: list[dict], network_id: str) -> str:
-    """Render messages as a markdown chat log."""
-    if not messages:
-        return f"No messages found in network **{network_id}**."
+def render_chat(messages: Iterable[sqlite3.Row], network_id: str) -> Iterator[str]:
+    """Render messages as a markdown chat log, one chunk per message."""
+    messages = iter(messages)
+    first = next(messages, None)
+    if first is None:
+        yield f"No messages found in network **{network_id}**.\n"
+        return
 
-    lines = [f"### Chat: {network_id}", ""]
+    yield f"### Chat: {network_id}\n\n"
 
-    for msg in messages:
+    # Summary figures are tallied as rows go by, never from a stored list
+    count = 0
+    agents = set()
+    for msg in chain((first,), messages):
         ts = format_timestamp(msg["created_at"])
         sender = msg["sender_id"]
         recipient = msg["recipient_id"]
@@ -128,21 +154,21 @@ def render_chat(messages: list[dict], network_id: str) -> str:
         else:
             header = f"**{sender}** -> {recipient} — {ts}"
 
-        lines.append(header)
         # Indent message content for visual separation
-        for line in content.strip().splitlines():
-            lines.append(f"> {line}")
-        lines.append("")
+        quoted = "".join(f"> {line}\n" for line in content.strip().splitlines())
+        yield f"{header}\n{quoted}\n"
+        count += 1
+        agents.add(sender)
 
     # Summary
-    agents = sorted(set(m["sender_id"] for m in messages))
-    lines.append("---")
-    lines.append(f"_{len(messages)} messages from {len(agents)} agents: {', '.join(agents)}_")
-
-    return "\n".join(lines)
+    agents = sorted(agents)
+    yield f"---\n_{count} messages from {len(agents)} agents: {', '.join(agents)}_\n"
 
 
 def main():
+    # Only the CLI needs it; importing this module for its helpers doesn't
+    import argparse
+
     parser = argparse.ArgumentParser(description="View agent network chat history")
     parser.add_argument("network", nargs="?", default=None, help="Network ID to view (omit to list all networks)")
     parser.add_argument("--since", help="Time filter (e.g. 30m, 2h, 1d)", default="")
@@ -164,7 +190,10 @@ def main():
             sys.exit(1)
 
     messages = fetch_messages(args.network, since_seconds, args.agent)
-    print(render_chat(messages, args.network))
+    # Written as it renders, so the whole transcript is never one string
+    write = sys.stdout.write
+    for chunk in render_chat(messages, args.network):
+        write(chunk)
 
 
 if __name__ == "__main__":